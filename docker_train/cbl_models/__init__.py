@@ -23,6 +23,8 @@ from .xception_v2 import XceptionBackbone
 from .repvgg import RepVGGBackBone
 
 from .timm_model import TIMM
+from .flat_params import FlatParams
+from .fuse import fuse_model
 
 
 def build_model(model_args):
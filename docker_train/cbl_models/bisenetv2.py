@@ -421,6 +421,10 @@ class BiSeNetV2TrainWrapper(nn.Module):
                 }
         return state
 
+    def load_states(self, state):
+        for name, child in self.named_children():
+            child.load_state_dict(state[name], strict=True)
+
 
 class BiSeNetV2TrainWrapperDenseCL(nn.Module):
 
@@ -475,6 +479,10 @@ class BiSeNetV2TrainWrapperDenseCL(nn.Module):
             }
         return state
 
+    def load_states(self, state):
+        for name, child in self.named_children():
+            child.load_state_dict(state[name], strict=True)
+
 
 if __name__ == "__main__":
     x = torch.randn(16, 3, 224, 224)
@@ -206,6 +206,7 @@ class Conv2dWS(nn.Conv2d):
             groups=groups,
             bias=bias)
         self.std_eps = eps
+        self.weight_folded = False
 
     def forward(self, x):
         weight = self.get_weight()
@@ -217,7 +218,14 @@ class Conv2dWS(nn.Conv2d):
                         self.dilation,
                         self.groups)
 
+    @torch.no_grad()
+    def fold_weight(self):
+        ## keep the transformed weight as a static one, for inference
+        self.weight.data = self.get_weight().detach().clone()
+        self.weight_folded = True
+
     def get_weight(self):
+        if self.weight_folded: return self.weight
         N, _, _, _ = self.weight.size()
         weight = self.weight
         mean = weight.mean(dim=(1, 2, 3), keepdim=True)
@@ -285,6 +293,7 @@ class NormConv2d(nn.Conv2d):
             bias=bias)
         assert kernel_size == 1, 'does not support other kernel sizes'
         self.eps = eps
+        self.weight_folded = False
 
     def forward(self, x):
         N, _, _, _ = x.size()
@@ -299,7 +308,14 @@ class NormConv2d(nn.Conv2d):
                         self.dilation,
                         self.groups)
 
+    @torch.no_grad()
+    def fold_weight(self):
+        ## keep the transformed weight as a static one, for inference
+        self.weight.data = self.get_weight().detach().clone()
+        self.weight_folded = True
+
     def get_weight(self):
+        if self.weight_folded: return self.weight
         N, _, _, _ = self.weight.size()
         weight = self.weight
         norm = weight.norm(2, dim=(1, 2, 3), keepdim=True)
@@ -0,0 +1,102 @@
+
+import torch
+import torch.nn as nn
+
+
+class FlatParams(object):
+    '''
+        copy parameters of all groups into one contiguous buffer and make
+        each parameter a view into it, gradients likewise. Each group is a
+        contiguous slice, exposed as one flat tensor in `self.groups` for
+        the optimizer, so optimizer steps and gradient clipping work on a
+        few large tensors no matter how many parameters the model has.
+
+        Gradients are accumulated in place into the views, so they must be
+        zeroed with `zero_grad(set_to_none=False)` rather than set to None.
+    '''
+
+    def __init__(self, *param_groups):
+        params = [p for group in param_groups for p in group]
+        assert len(params) == len(set(params)), 'parameter in more than one group'
+        assert len(set((p.device, p.dtype) for p in params)) == 1
+        n_elem = sum(p.numel() for p in params)
+        self.data = torch.empty(n_elem, dtype=params[0].dtype, device=params[0].device)
+        self.grad = torch.zeros_like(self.data)
+
+        self.groups = []
+        offset = 0
+        for group in param_groups:
+            start = offset
+            for p in group:
+                n = p.numel()
+                self.data[offset:offset + n].copy_(p.data.view(-1))
+                p.data = self.data[offset:offset + n].view_as(p)
+                p.grad = self.grad[offset:offset + n].view_as(p)
+                offset += n
+            flat = nn.Parameter(self.data[start:offset], requires_grad=False)
+            flat.grad = self.grad[start:offset]
+            self.groups.append(flat)
+
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm):
+        ## one reduction over the whole gradient buffer
+        norm = self.grad.norm()
+        scale = (max_norm / (norm + 1e-6)).clamp_(max=1.)
+        self.grad.mul_(scale)
+        return norm
+
+
+if __name__ == '__main__':
+    import time
+    from copy import deepcopy
+    from cbl_models import EfficientNet
+
+    ## same steps with and without the flat buffers
+    torch.manual_seed(0)
+    model = EfficientNet('b0_sepconv', n_classes=10)
+    model_flat = deepcopy(model)
+    wd = [p for p in model_flat.parameters() if p.dim() > 1]
+    non_wd = [p for p in model_flat.parameters() if p.dim() <= 1]
+    flat_params = FlatParams(wd, non_wd)
+    optim = torch.optim.SGD([p for p in model.parameters()], lr=0.1, momentum=0.9)
+    optim_flat = torch.optim.SGD(flat_params.groups, lr=0.1, momentum=0.9)
+    inten = torch.randn(2, 3, 64, 64)
+    for _ in range(3):
+        optim.zero_grad()
+        model(inten).sum().backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.)
+        optim.step()
+        optim_flat.zero_grad(set_to_none=False)
+        model_flat(inten).sum().backward()
+        flat_params.clip_grad_norm_(1.)
+        optim_flat.step()
+    diff = max((p1 - p2).abs().max().item() for p1, p2 in
+            zip(model.parameters(), model_flat.parameters()))
+    print(f'max param diff: {diff:.2e}')
+    assert diff < 1e-5
+
+    ## clip + step time
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model.to(device)
+    for p in model.parameters(): p.grad = torch.randn_like(p)
+    wd = [p for p in model.parameters() if p.dim() > 1]
+    non_wd = [p for p in model.parameters() if p.dim() <= 1]
+    optim = torch.optim.AdamW([{'params': wd}, {'params': non_wd}])
+    def step():
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.)
+        optim.step()
+    def step_flat():
+        flat_params.clip_grad_norm_(1.)
+        optim_flat.step()
+    for name, func in (('per-tensor', step), ('flat', step_flat)):
+        if name == 'flat':
+            ## the grads become views of a zeroed buffer, refill them
+            flat_params = FlatParams(wd, non_wd)
+            flat_params.grad.normal_()
+            optim_flat = torch.optim.AdamW(flat_params.groups)
+        for _ in range(3): func()
+        if device == 'cuda': torch.cuda.synchronize()
+        t1 = time.time()
+        for _ in range(50): func()
+        if device == 'cuda': torch.cuda.synchronize()
+        print(f'{name}: {(time.time() - t1) / 50 * 1e3:.3f} ms/step')
@@ -0,0 +1,184 @@
+
+import logging
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+import torch.fx as fx
+from torch.nn.modules.batchnorm import _BatchNorm
+
+
+'''
+    Generic inference-time fusion of Conv2d and BatchNorm. The model is
+    traced with torch.fx only to find which modules feed which, fusion
+    itself replaces submodules in place (the conv by the fused conv, the bn
+    by nn.Identity), so the model keeps its class and methods such as
+    `get_states`.
+'''
+
+
+class LeafTracer(fx.Tracer):
+    ## keep convs, including the weight-transform subclasses, and norms as nodes
+    def is_leaf_module(self, mod, qualname):
+        if isinstance(mod, (nn.Conv2d, _BatchNorm)): return True
+        return super(LeafTracer, self).is_leaf_module(mod, qualname)
+
+
+def is_static_conv(mod):
+    return type(mod) is nn.Conv2d or getattr(mod, 'weight_folded', False)
+
+
+def is_foldable_bn(mod):
+    return (isinstance(mod, _BatchNorm) and mod.track_running_stats
+            and not mod.running_mean is None)
+
+
+def find_conv_bn_pairs(model):
+    '''
+        (conv_name, bn_name, order) of conv->bn and bn->conv pairs, where
+        both modules are called once and the output of the first one only
+        goes into the second one
+    '''
+    graph = LeafTracer().trace(model)
+    modules = dict(model.named_modules())
+    n_calls = {}
+    for node in graph.nodes:
+        if node.op == 'call_module':
+            n_calls[node.target] = n_calls.get(node.target, 0) + 1
+
+    pairs = []
+    for node in graph.nodes:
+        if node.op != 'call_module' or n_calls[node.target] != 1: continue
+        if len(node.args) != 1 or len(node.kwargs) > 0: continue
+        prev = node.args[0]
+        if not isinstance(prev, fx.Node) or prev.op != 'call_module': continue
+        if n_calls[prev.target] != 1 or len(prev.users) != 1: continue
+        mod, prev_mod = modules[node.target], modules[prev.target]
+        if is_static_conv(prev_mod) and is_foldable_bn(mod):
+            pairs.append((prev.target, node.target, 'conv_bn'))
+        elif is_foldable_bn(prev_mod) and can_fold_bn_into_conv(mod):
+            pairs.append((node.target, prev.target, 'bn_conv'))
+    return pairs
+
+
+def find_sequential_pairs(model):
+    ## used when the model cannot be traced: adjacent conv, bn in nn.Sequential
+    pairs = []
+    for name, mod in model.named_modules():
+        if not isinstance(mod, nn.Sequential): continue
+        children = list(mod.named_children())
+        for (n1, m1), (n2, m2) in zip(children[:-1], children[1:]):
+            if is_static_conv(m1) and is_foldable_bn(m2):
+                prefix = f'{name}.' if name else ''
+                pairs.append((prefix + n1, prefix + n2, 'conv_bn'))
+    return pairs
+
+
+def can_fold_bn_into_conv(conv):
+    # zero padding would be applied after bn in the original graph, so only
+    # convs without padding can take the bn in front of them
+    if not type(conv) is nn.Conv2d or conv.groups != 1: return False
+    return conv.padding in ((0, 0), 'valid')
+
+
+@torch.no_grad()
+def fuse_bn_conv_eval(bn, conv):
+    '''
+        fold bn in front of a conv: conv(x * s + t) == (w * s)(x) + w(t) + b
+    '''
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    fused = deepcopy(conv)
+    weight = conv.weight
+    bias = torch.zeros_like(weight[:, 0, 0, 0]) if conv.bias is None else conv.bias
+    fused.weight = nn.Parameter(weight * scale.view(1, -1, 1, 1))
+    fused.bias = nn.Parameter(bias + (weight.sum(dim=(2, 3)) * shift.view(1, -1)).sum(dim=1))
+    return fused
+
+
+def set_module(model, name, mod):
+    parent_name, _, attr = name.rpartition('.')
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, attr, mod)
+
+
+def fuse_model(model):
+    '''
+        re-parameterize (`fuse_block`), fold weight transforms of
+        Conv2dWS/NormConv2d, and fold every bn into its neighbouring conv.
+        Works in place on a model in eval mode, which is returned.
+    '''
+    model.eval()
+    if hasattr(model, 'fuse_block'): model.fuse_block()
+    for mod in model.modules():
+        if hasattr(mod, 'fold_weight'): mod.fold_weight()
+    try:
+        pairs = find_conv_bn_pairs(model)
+    except Exception as e:
+        # forward is not traceable (data dependent control flow etc.), use
+        # the hand written fusion of blocks if any, and nn.Sequential pairs
+        logging.getLogger().warning(f'{type(model).__name__} cannot be traced '
+                f'for fusion ({type(e).__name__}: {e}), fall back to '
+                'fuse_conv_bn and conv/bn pairs in nn.Sequential')
+        if hasattr(model, 'fuse_conv_bn'): model.fuse_conv_bn()
+        pairs = find_sequential_pairs(model)
+    for conv_name, bn_name, order in pairs:
+        conv, bn = model.get_submodule(conv_name), model.get_submodule(bn_name)
+        if order == 'conv_bn':
+            fused = torch.nn.utils.fuse_conv_bn_eval(conv, bn)
+        else:
+            fused = fuse_bn_conv_eval(bn, conv)
+        set_module(model, conv_name, fused)
+        set_module(model, bn_name, nn.Identity())
+    return model
+
+
+if __name__ == '__main__':
+    import time
+    from cbl_models import (ResNet, EfficientNet, EfficientNetLite, Xception41,
+            PAResNet, RepVGG, BiSeNetV2TrainWrapper)
+
+    def count_bn(model):
+        return sum(isinstance(mod, _BatchNorm) for mod in model.modules())
+
+    def latency(model, inten, n_iters=10):
+        with torch.no_grad():
+            for _ in range(2): model(inten)
+            t1 = time.time()
+            for _ in range(n_iters): model(inten)
+        return (time.time() - t1) / n_iters * 1e3
+
+    ## cpu latency and outputs before and after fusion, bn statistics are
+    ## randomized so that folding is not an identity
+    torch.set_grad_enabled(False)
+    inten = torch.randn(1, 3, 224, 224)
+    models = [
+        ('resnet50', lambda: ResNet(n_layers=50)),
+        ('effnet_b0', lambda: EfficientNet('b0_sepconv')),
+        ('effnet_lite_b0', lambda: EfficientNetLite('b0_sepconv')),
+        ('xception41', lambda: Xception41()),
+        ('pa_resnet50', lambda: PAResNet(n_layers=50)),
+        ('repvgg_a1', lambda: RepVGG(mtype='a1')),
+        ('bisenetv2', lambda: BiSeNetV2TrainWrapper(n_classes=1000)),
+    ]
+    for name, build in models:
+        model = build()
+        for mod in model.modules():
+            if isinstance(mod, _BatchNorm):
+                mod.running_mean.uniform_(-0.1, 0.1)
+                mod.running_var.uniform_(0.5, 1.5)
+        model.eval()
+        out = model(inten)
+        out = out[0] if isinstance(out, (tuple, list)) else out
+        n_bn, t_before = count_bn(model), latency(model, inten)
+        fuse_model(model)
+        out_fused = model(inten)
+        out_fused = out_fused[0] if isinstance(out_fused, (tuple, list)) else out_fused
+        diff = (out - out_fused).abs().max().item()
+        print(f'{name}: bn {n_bn} -> {count_bn(model)}, '
+              f'latency {t_before:.2f}ms -> {latency(model, inten):.2f}ms, '
+              f'max diff {diff:.2e}')
+        assert diff <= 1e-3 * max(1., out.abs().max().item()), name
@@ -236,6 +236,10 @@ class PAResNetBase(nn.Module):
             classifier=self.classifier.state_dict())
         return state
 
+    def load_states(self, state):
+        self.backbone.load_state_dict(state['backbone'], strict=True)
+        self.classifier.load_state_dict(state['classifier'], strict=True)
+
 ## resnet-v2
 class PAResNetBackbone(PAResNetBackBoneBase):
 
@@ -207,6 +207,10 @@ class UShapeEffNetB0ClassificationWrapper(nn.Module):
             classifier=self.classifier.state_dict())
         return state
 
+    def load_states(self, state):
+        self.backbone.load_state_dict(state['backbone'], strict=True)
+        self.classifier.load_state_dict(state['classifier'], strict=True)
+
 
 if __name__ == "__main__":
     inten = torch.randn(8, 3, 256, 256)
@@ -264,6 +264,10 @@ class Xception(nn.Module):
             classifier=self.classifier.state_dict())
         return state
 
+    def load_states(self, state):
+        self.backbone.load_state_dict(state['backbone'], strict=True)
+        self.classifier.load_state_dict(state['classifier'], strict=True)
+
 class Xception41(Xception):
 
     def __init__(self, n_classes=1000):
@@ -0,0 +1,89 @@
+
+import os
+import os.path as osp
+import glob
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(el) for el in obj)
+    return obj
+
+
+def get_rng_states():
+    ## numpy keys as a tensor, so that loading needs no pickled numpy objects
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    state = dict(
+        torch=torch.get_rng_state(),
+        numpy=(name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached),
+        random=random.getstate(),
+    )
+    if torch.cuda.is_available(): state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_states(state):
+    name, keys, pos, has_gauss, cached = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached))
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['random'])
+    if 'cuda' in state: torch.cuda.set_rng_state(state['cuda'])
+
+
+def list_checkpoints(save_dir):
+    return sorted(glob.glob(osp.join(save_dir, 'ckpt_*.pth')))
+
+
+def load_latest_checkpoint(save_dir):
+    ckpts = list_checkpoints(save_dir)
+    if len(ckpts) == 0: return None
+    return torch.load(ckpts[-1], map_location='cpu')
+
+
+class AsyncCheckpointer(object):
+    '''
+        `save()` only blocks for copying the state to cpu, serializing and
+        writing happen in a background thread. Files are written under a
+        temporary name and renamed into place, and the `keep` most recent
+        ones are kept.
+    '''
+
+    def __init__(self, save_dir, keep=2):
+        ## [:-0] would select nothing to remove and keep every checkpoint
+        assert keep >= 1, 'keep at least one checkpoint to resume from'
+        self.save_dir = save_dir
+        self.keep = keep
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        if not osp.exists(save_dir): os.makedirs(save_dir, exist_ok=True)
+
+    def save(self, state, epoch):
+        state = to_cpu(state)
+        self.wait()
+        self.pending = self.worker.submit(self.write, state, epoch)
+
+    def write(self, state, epoch):
+        pth = osp.join(self.save_dir, f'ckpt_{epoch:04d}.pth')
+        tmp_pth = f'{pth}.tmp'
+        torch.save(state, tmp_pth)
+        os.replace(tmp_pth, pth)
+        for old_pth in list_checkpoints(self.save_dir)[:-self.keep]:
+            os.remove(old_pth)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.worker.shutdown()
@@ -16,10 +16,20 @@ grad_clip_norm = 10
 dataset_args = dict(
         ds_type='ImageNet', root='./datasets/imagenet/',
         cropsize=224,
+        #  val_cache_root='./datasets/imagenet/val_cache/',
+        #  batch_aug=True,
+        #  fused_trans=True, # not together with batch_aug
+        #  reduced_decode=True,
+        #  cache_index=True,
         )
 print_freq = 200
 num_workers = 4
 ema_alpha = 0.9999
+#  ema_args = dict(update_every=4, device='cpu') # or dtype='bfloat16' for half the memory
+#  accum_steps = 2 # micro-batches per batch, to fit batchsize with less memory
+#  ckpt_every = 1 # epochs between checkpoints in ./res/ckpt, resume with --resume
+#  ckpt_keep = 2
+#  use_flat_params = True # params as views of one buffer, for fast clipping and steps
 use_mixed_precision = True
 use_sync_bn = False
 use_mixup = False
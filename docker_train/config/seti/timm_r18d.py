@@ -26,11 +26,21 @@ dataset_args = dict(
         ds_type='SETI', root='./datasets/seti/',
         cropsize=512, binary=True
         )
+## packed once with: python -m data.seti_store --root ./datasets/seti/
+#  dataset_args = dict(
+#          ds_type='SETIStore', root='./datasets/seti/',
+#          store_root='./datasets/seti/store/', fold=1, norm_stats=True,
+#          cropsize=512, binary=True
+#          )
+## overrides of dataset_args with train.py --folds, folds are picked from them
+fold_dataset_args = dict(ann_file='train_all.txt')
+#  fold_dataset_args = dict(fold=None) # SETIStore
 print_freq = 50
 metric = 'roc_auc'
 num_workers = 4
 grad_clip_norm = 10
 ema_alpha = 0.999
+#  ema_args = dict(update_every=4, device='cpu') # or dtype='bfloat16' for half the memory
 use_mixed_precision = True
 use_sync_bn = False
 use_mixup = True
@@ -1,7 +1,9 @@
 
 from copy import deepcopy
 from .imagenet_cv2 import ImageNet
+from .imagenet_shard import ImageNetShard
 from .seti import SETI
+from .seti_store import SETIStore
 
 
 
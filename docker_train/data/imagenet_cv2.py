@@ -10,36 +10,41 @@ import torchvision
 import transforms as T
 
 from rand_augment_cv2 import RandomAugment
+from rand_augment_batch import BatchRandomAugment
+from .val_cache import ValCache
+from .sample_index import SampleIndex
+
+
+def read_ann_file(root, mode, cache=False):
+    txtpth = osp.join(root, f'{mode}.txt')
+    img_root_pth = osp.join(root, mode)
+    return SampleIndex.from_ann_file(txtpth, img_root_pth, sep=' ', cache=cache)
 
 
 class ImageNet(Dataset):
 
-    def __init__(self, root='./', mode='train', cropsize=224):
+    def __init__(self, root='./', mode='train', cropsize=224, val_cache_root=None,
+            batch_aug=False, fused_trans=False, reduced_decode=False,
+            cache_index=False):
         super(ImageNet, self).__init__()
-        self.samples = []
+        ## fused_trans writes normalized float samples, batch_aug needs uint8
+        assert not (fused_trans and batch_aug), 'fused_trans and batch_aug cannot both be set'
         self.mode = mode
         self.cropsize = cropsize
-        if mode == 'train':
-            txtpth = osp.join(root, 'train.txt')
-            img_root_pth = osp.join(root, 'train')
-            with open(txtpth, 'r') as fr:
-                lines = fr.read().splitlines()
-            for line in lines:
-                pth, lb = line.split(' ')
-                pth, lb = osp.join(img_root_pth, pth), int(lb)
-                self.samples.append((pth, lb))
-        elif mode == 'val':
-            txtpth = osp.join(root, 'val.txt')
-            img_root_pth = osp.join(root, 'val')
-            with open(txtpth, 'r') as fr:
-                lines = fr.read().splitlines()
-            for line in lines:
-                pth, lb = line.split(' ')
-                pth, lb = osp.join(img_root_pth, pth), int(lb)
-                self.samples.append((pth, lb))
+        self.fused_trans = fused_trans
+        self.out_buf = None
+        self.reduced_decode = reduced_decode
+        self.cache_index = cache_index
+        self.samples = self.load_samples(root, mode)
         img_mean, img_std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+        ## with reduced_decode, train transforms take encoded bytes and
+        ## decode at the lowest resolution the random crop allows
+        if reduced_decode:
+            random_resized_crop = T.DecodeRandomResizedCrop(cropsize)
+        else:
+            random_resized_crop = T.RandomResizedCrop(cropsize)
         self.trans_train = T.Compose([
-            T.RandomResizedCrop(cropsize),
+            random_resized_crop,
             T.RandomHorizontalFlip(),
             RandomAugment(2, 9),
             T.ToTensor(),
@@ -47,27 +52,91 @@ class ImageNet(Dataset):
             T.Normalize(img_mean, img_std)
             #  T.ColorJitter(0.4, 0.4, 0.4),
         ])
+        if fused_trans:
+            self.trans_train = T.RandomResizedCropFlipNormalize(
+                cropsize, img_mean, img_std, pca_std=0.1,
+                mid_trans=RandomAugment(2, 9))
+        ## with batch_aug, workers only decode and crop, the rest is applied
+        ## to the collated uint8 batch by the training loop
+        self.batch_trans_train = None
+        if batch_aug:
+            self.trans_train = T.Compose([
+                random_resized_crop,
+                T.RandomHorizontalFlip(),
+                T.ToCHW(),
+            ])
+            self.batch_trans_train = T.Compose([
+                BatchRandomAugment(2, 9),
+                T.BatchToTensor(),
+                T.BatchPCANoise(0.1),
+                T.BatchNormalize(img_mean, img_std)
+            ])
         short_size = int(cropsize * 256 / 224)
+        self.resize_crop_val = T.ResizeCenterCrop(
+                crop_size=cropsize, short_size=short_size)
         self.trans_val = T.Compose([
-            T.ResizeCenterCrop(crop_size=cropsize, short_size=short_size),
+            self.resize_crop_val,
             T.ToTensor(),
             T.Normalize(img_mean, img_std)
         ])
+        self.val_cache = None
+        if mode == 'val' and val_cache_root is not None:
+            self.val_cache = ValCache(val_cache_root,
+                    osp.join(root, 'val.txt'), len(self.samples),
+                    self.resize_crop_val.crop_size, short_size,
+                    self.resize_crop_val.interpolation, img_mean, img_std)
+
+    def load_samples(self, root, mode):
+        return read_ann_file(root, mode, cache=self.cache_index)
 
     def readimg(self, impth):
         im = cv2.imread(impth, cv2.IMREAD_COLOR)
         im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
         return im
 
+    def load_img(self, idx):
+        return self.readimg(self.samples.get_path(idx))
+
+    def load_bytes(self, idx):
+        return np.fromfile(self.samples.get_path(idx), dtype=np.uint8)
+
+    def get_label(self, idx):
+        return self.samples.get_label(idx)
+
     def __getitem__(self, idx):
-        impth, label = self.samples[idx]
-        im = self.readimg(impth)
-        if self.mode == 'train':
-            im = self.trans_train(im)
+        label = self.get_label(idx)
+        if self.mode == 'train' and self.reduced_decode:
+            im = self.trans_train(self.load_bytes(idx))
+        elif self.mode == 'train':
+            im = self.trans_train(self.load_img(idx))
+        elif self.val_cache is None:
+            im = self.trans_val(self.load_img(idx))
         else:
-            im = self.trans_val(im)
+            im = self.val_cache.fetch(idx,
+                    lambda: self.resize_crop_val(self.load_img(idx)))
         return im, label
 
+    def __getitems__(self, inds):
+        '''
+            batched fetch of the dataloader, the fused train transform writes
+            each sample into a slice of a batch buffer reused across batches,
+            collate copies them out before the next call
+        '''
+        if not (self.mode == 'train' and self.fused_trans):
+            return [self[idx] for idx in inds]
+        shape = (len(inds), 3, self.cropsize, self.cropsize)
+        if self.out_buf is None or self.out_buf.shape[0] < len(inds):
+            self.out_buf = np.empty(shape, dtype=np.float32)
+        samples = []
+        for ii, idx in enumerate(inds):
+            if self.reduced_decode:
+                img = self.load_bytes(idx)
+            else:
+                img = self.load_img(idx)
+            im = self.trans_train(img, out=self.out_buf[ii])
+            samples.append((torch.from_numpy(im), self.get_label(idx)))
+        return samples
+
     #  def __getitem__(self, idx):
     #      import cdataloader
     #      impth, label = self.samples[idx]
@@ -0,0 +1,138 @@
+import os
+import os.path as osp
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from .imagenet_cv2 import ImageNet, read_ann_file
+
+
+'''
+    Packed shard layout of one split, written by `pack_shards`:
+
+        {mode}_00000.bin, {mode}_00001.bin, ...  encoded jpeg bytes, back to back
+        {mode}_index.npy                         int64 (N, 4): shard, offset, length, label
+        {mode}_meta.json                         shard file names and sample count
+
+    Images are stored as the original encoded bytes, so decoding and the
+    augmentation pipelines are identical to the per-file reader.
+'''
+
+
+def pack_shards(root, mode='train', save_root=None, shard_size=1 << 30):
+    '''
+        pack images listed in {root}/{mode}.txt into shards of about
+        `shard_size` bytes
+    '''
+    if save_root is None: save_root = osp.join(root, 'shards')
+    if not osp.exists(save_root): os.makedirs(save_root)
+    samples = read_ann_file(root, mode)
+
+    index = np.zeros((len(samples), 4), dtype=np.int64)
+    shard_names = []
+    fw, offset = None, 0
+    for ind, (impth, lb) in enumerate(samples):
+        if fw is None or offset >= shard_size:
+            if fw is not None: fw.close()
+            shard_names.append(f'{mode}_{len(shard_names):05d}.bin')
+            fw = open(osp.join(save_root, shard_names[-1]), 'wb')
+            offset = 0
+        with open(impth, 'rb') as fr:
+            buf = fr.read()
+        fw.write(buf)
+        index[ind] = (len(shard_names) - 1, offset, len(buf), lb)
+        offset += len(buf)
+    if fw is not None: fw.close()
+
+    np.save(osp.join(save_root, f'{mode}_index.npy'), index)
+    meta = dict(shards=shard_names, n_samples=len(samples))
+    with open(osp.join(save_root, f'{mode}_meta.json'), 'w') as fw:
+        json.dump(meta, fw)
+    return index
+
+
+class ImageNetShard(ImageNet):
+    '''
+        same as ImageNet, but reads encoded images from memory-mapped shards
+        generated by `pack_shards` instead of one file per sample
+    '''
+
+    def __init__(self, root='./', mode='train', cropsize=224, shard_root=None,
+            val_cache_root=None, batch_aug=False, fused_trans=False,
+            reduced_decode=False, cache_index=False):
+        self.shard_root = osp.join(root, 'shards') if shard_root is None else shard_root
+        self.shards = None
+        super(ImageNetShard, self).__init__(root, mode, cropsize,
+                val_cache_root, batch_aug, fused_trans, reduced_decode,
+                cache_index)
+
+    def load_samples(self, root, mode):
+        with open(osp.join(self.shard_root, f'{mode}_meta.json'), 'r') as fr:
+            meta = json.load(fr)
+        self.shard_pths = [osp.join(self.shard_root, el) for el in meta['shards']]
+        samples = np.load(osp.join(self.shard_root, f'{mode}_index.npy'))
+        assert samples.shape[0] == meta['n_samples']
+        return samples
+
+    def open_shards(self):
+        # opened lazily, so that each dataloader worker maps shards by itself
+        self.shards = [np.memmap(pth, dtype=np.uint8, mode='r')
+                for pth in self.shard_pths]
+
+    def load_bytes(self, idx):
+        if self.shards is None: self.open_shards()
+        shard_ind, offset, length, _ = self.samples[idx]
+        return self.shards[shard_ind][offset:offset + length]
+
+    def load_img(self, idx):
+        im = cv2.imdecode(self.load_bytes(idx), cv2.IMREAD_COLOR)
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        return im
+
+    def get_label(self, idx):
+        return int(self.samples[idx, 3])
+
+    def __getstate__(self):
+        # do not pickle memmaps into spawned workers
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+def benchmark(ds, n_samples=2000, batchsize=256, num_workers=8):
+    inds = np.random.permutation(len(ds))[:n_samples].tolist()
+    dl = DataLoader(torch.utils.data.Subset(ds, inds), batch_size=batchsize,
+            shuffle=False, num_workers=num_workers, drop_last=False)
+    t1 = time.time()
+    for ims, lbs in dl: pass
+    return len(inds) / (time.time() - t1)
+
+
+if __name__ == "__main__":
+    # run from docker_train: python -m data.imagenet_shard --root ./datasets/imagenet --pack
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--root', dest='root', type=str, default='./datasets/imagenet/')
+    parse.add_argument('--mode', dest='mode', type=str, default='train')
+    parse.add_argument('--pack', dest='pack', action='store_true')
+    parse.add_argument('--shard-size', dest='shard_size', type=int, default=1 << 30)
+    parse.add_argument('--n-samples', dest='n_samples', type=int, default=20000)
+    parse.add_argument('--num-workers', dest='num_workers', type=int, default=8)
+    args = parse.parse_args()
+
+    if args.pack:
+        pack_shards(args.root, args.mode, shard_size=args.shard_size)
+
+    ## compare samples/sec against the per-file reader, each run draws its own
+    ## random subset, drop page cache between runs for cold-read numbers
+    ds_file = ImageNet(args.root, mode=args.mode)
+    ds_shard = ImageNetShard(args.root, mode=args.mode)
+    assert len(ds_file) == len(ds_shard)
+    sps_file = benchmark(ds_file, args.n_samples, num_workers=args.num_workers)
+    sps_shard = benchmark(ds_shard, args.n_samples, num_workers=args.num_workers)
+    print(f'per-file reader: {sps_file:.2f} samples/sec')
+    print(f'shard reader: {sps_shard:.2f} samples/sec')
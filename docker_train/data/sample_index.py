@@ -0,0 +1,77 @@
+import os
+import os.path as osp
+import numpy as np
+
+
+class SampleIndex(object):
+    '''
+        compact list of (path, label): paths are stored in one contiguous
+        byte buffer addressed by int64 offsets, labels in an int32 array.
+        Unlike a list of tuples there is no per-sample python object, so
+        reading samples does not update refcounts, and the copy-on-write
+        pages inherited by dataloader workers stay shared.
+    '''
+
+    def __init__(self, paths, offsets, labels, root=''):
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+        self.root = root
+
+    @classmethod
+    def from_ann_file(cls, txtpth, root='', sep=' ', cache=False):
+        '''
+            parse lines of "path{sep}label", with cache=True the parsed
+            arrays are saved next to txtpth and reused until it changes
+        '''
+        cache_pth = f'{txtpth}.index.npz'
+        stat = os.stat(txtpth)
+        src_stat = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if cache and osp.exists(cache_pth):
+            with np.load(cache_pth) as state:
+                if np.array_equal(state['src_stat'], src_stat):
+                    return cls(state['paths'], state['offsets'],
+                            state['labels'], root)
+
+        with open(txtpth, 'rb') as fr:
+            lines = [el for el in fr.read().splitlines() if el]
+        pairs = [el.rsplit(sep.encode(), 1) for el in lines]
+        pths = [el[0] for el in pairs]
+        # empty annotation files give an empty index
+        labels = np.array([el[1] for el in pairs]).astype(np.int32)
+        offsets = np.zeros(len(pths) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, pths), dtype=np.int64,
+            count=len(pths)), out=offsets[1:])
+        paths = np.frombuffer(b''.join(pths), dtype=np.uint8)
+        index = cls(paths, offsets, labels, root)
+        if cache: index.save(cache_pth, src_stat)
+        return index
+
+    def save(self, pth, src_stat):
+        # written to a temporary file first, ranks may do this at the same time
+        tmp_pth = f'{pth}.{os.getpid()}.tmp.npz'
+        try:
+            np.savez(tmp_pth, paths=self.paths, offsets=self.offsets,
+                    labels=self.labels, src_stat=src_stat)
+            os.replace(tmp_pth, pth)
+        except OSError:
+            if osp.exists(tmp_pth): os.remove(tmp_pth)
+
+    def get_path(self, idx):
+        pth = self.paths[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode()
+        return osp.join(self.root, pth)
+
+    def get_label(self, idx):
+        return int(self.labels[idx])
+
+    def __getitem__(self, idx):
+        if idx < 0: idx += len(self)
+        if not 0 <= idx < len(self): raise IndexError
+        return self.get_path(idx), self.get_label(idx)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
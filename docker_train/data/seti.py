@@ -12,26 +12,47 @@ import torchvision
 import transforms as T
 
 from rand_augment_cv2 import RandomAugment
+from .sample_index import SampleIndex
+
+
+def read_cadence(impth, out=None):
+    '''
+        read cadence of (6, 273, 256), on-target rows (0, 2, 4) are stacked
+        along height to channel 0 and off-target rows (1, 3, 5) to channel 1,
+        giving float32 (256, 819, 2). The file is mapped once and converted
+        with one strided copy per channel into `out`, which is allocated if
+        None.
+    '''
+    return cadence_to_image(np.load(impth, mmap_mode='r'), out)
+
+
+def cadence_to_image(arr, out=None):
+    n_cad, H, W = arr.shape
+    if out is None or out.shape != (W, H * n_cad // 2, 2):
+        out = np.empty((W, H * n_cad // 2, 2), dtype=np.float32)
+    # out[w, c * H + h, k] = arr[2 * c + k, h, w], copying on and off rows
+    # separately is faster than one copy with k as the innermost index
+    src = arr.reshape(n_cad // 2, 2, H, W)
+    dst = out.reshape(W, n_cad // 2, H, 2)
+    for k in range(2):
+        np.copyto(dst[..., k], src[:, k].transpose(2, 0, 1))
+    return out
 
 
 class SETI(Dataset):
 
-    def __init__(self, root='./', mode='train', cropsize=224, binary=True):
+    def __init__(self, root='./', mode='train', cropsize=224, binary=True,
+            cache_index=False, ann_file=None):
         super(SETI, self).__init__()
-        self.samples = []
+        self.root = root
         self.mode = mode
+        self.ann_file = ann_file
         self.cropsize = cropsize
         self.binary = binary
-        if mode == 'train':
-            txtpth = osp.join(root, 'train.txt')
-        elif mode == 'val':
-            txtpth = osp.join(root, 'val.txt')
-        with open(txtpth, 'r') as fr:
-            lines = fr.read().splitlines()
-        for line in lines:
-            pth, lb = line.split(',')
-            pth, lb = osp.join(root, pth), int(lb)
-            self.samples.append((pth, lb))
+        self.cache_index = cache_index
+        self.im_buf = None
+        self.samples = self.load_samples(root, mode)
+        mean, std, max_pixel_value = self.get_norm_args()
 
         self.trans_train = A.Compose([
             A.Resize(p=1., height=cropsize, width=cropsize),
@@ -43,14 +64,14 @@ class SETI(Dataset):
                 value=0, mask_value=0),
             A.RandomResizedCrop(p=1.0, width=cropsize,
                 height=cropsize, scale=(0.9, 1.0)),
-            A.Normalize(mean=(0.4),std=(0.2),max_pixel_value=180.,p=1.),
+            A.Normalize(mean=mean, std=std, max_pixel_value=max_pixel_value, p=1.),
             ToTensorV2(),
             #  RandomAugment(2, 9),
             #  T.PCANoise(0.1),
         ])
         self.trans_val = A.Compose([
             A.Resize(p=1., height=cropsize, width=cropsize),
-            A.Normalize(mean=(0.4),std=(0.2),max_pixel_value=180.,p=1.),
+            A.Normalize(mean=mean, std=std, max_pixel_value=max_pixel_value, p=1.),
             ToTensorV2(),
         ])
 
@@ -60,18 +81,42 @@ class SETI(Dataset):
     #      im = im.T.astype('f')[..., np.newaxis] # (256, 819, 1)
     #      return im
 
+    def load_samples(self, root, mode):
+        if not self.ann_file is None:
+            txtpth = osp.join(root, self.ann_file)
+        elif mode == 'train':
+            txtpth = osp.join(root, 'train.txt')
+        elif mode == 'val':
+            txtpth = osp.join(root, 'val.txt')
+        return SampleIndex.from_ann_file(txtpth, root, sep=',',
+                cache=self.cache_index)
+
+    def get_fold_inds(self, fold):
+        '''
+            indices of samples listed in folds/{mode}_fold_{fold}.txt, used
+            with ann_file='train_all.txt' to train folds in one process
+        '''
+        pth_inds = {self.samples.get_path(i): i for i in range(len(self.samples))}
+        fold_index = SampleIndex.from_ann_file(osp.join(self.root, 'folds',
+            f'{self.mode}_fold_{fold}.txt'), self.root, sep=',')
+        return [pth_inds[fold_index.get_path(i)] for i in range(len(fold_index))]
+
+    def get_norm_args(self):
+        return (0.4), (0.2), 180.
+
+    def load_img(self, idx):
+        return self.readimg(self.samples.get_path(idx))
+
+    def get_label(self, idx):
+        return self.samples.get_label(idx)
+
     def readimg(self, impth):
-        im_on = np.load(impth)[[0, 2, 4]] # (3, 273, 256)
-        im_off = np.load(impth)[[1, 3, 5]] # (3, 273, 256)
-        im_on = np.vstack(im_on).T[..., np.newaxis] # (256, 819, 1)
-        im_off = np.vstack(im_off).T[..., np.newaxis] # (256, 819, 1)
-        im = np.concatenate([im_on, im_off], axis=2)
-        im = im.astype('f') # (256, 819, 2)
-        return im
+        # buffer is reused, trans_train/trans_val start with Resize which copies
+        self.im_buf = read_cadence(impth, self.im_buf)
+        return self.im_buf
 
     def __getitem__(self, idx):
-        impth, label = self.samples[idx]
-        im = self.readimg(impth)
+        im, label = self.load_img(idx), self.get_label(idx)
         if self.mode == 'train':
             im = self.trans_train(image=im)
         else:
@@ -85,4 +130,43 @@ class SETI(Dataset):
 
 
 if __name__ == "__main__":
-    pass
+    import time
+    import tempfile
+    import tracemalloc
+
+    def readimg_legacy(impth):
+        im_on = np.load(impth)[[0, 2, 4]] # (3, 273, 256)
+        im_off = np.load(impth)[[1, 3, 5]] # (3, 273, 256)
+        im_on = np.vstack(im_on).T[..., np.newaxis] # (256, 819, 1)
+        im_off = np.vstack(im_off).T[..., np.newaxis] # (256, 819, 1)
+        im = np.concatenate([im_on, im_off], axis=2)
+        im = im.astype('f') # (256, 819, 2)
+        return im
+
+    def bench(read_func, pths, n_rounds=5):
+        read_func(pths[0])
+        t1 = time.time()
+        for _ in range(n_rounds):
+            for pth in pths: read_func(pth)
+        latency = (time.time() - t1) / (n_rounds * len(pths))
+        tracemalloc.start()
+        read_func(pths[0])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return latency, peak
+
+    with tempfile.TemporaryDirectory() as tmp_root:
+        pths = []
+        for i in range(64):
+            pths.append(osp.join(tmp_root, f'{i}.npy'))
+            np.save(pths[-1], np.random.randn(6, 273, 256).astype(np.float16))
+        buf = [None]
+        def read_reuse(pth):
+            buf[0] = read_cadence(pth, buf[0])
+            return buf[0]
+
+        for name, func in (('legacy', readimg_legacy),
+                ('read_cadence', read_cadence), ('read_cadence reuse', read_reuse)):
+            latency, peak = bench(func, pths)
+            print(f'{name}: {latency * 1e3:.3f} ms/sample, '
+                  f'peak allocated: {peak / 1024:.1f} KiB')
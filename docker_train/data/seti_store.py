@@ -0,0 +1,181 @@
+import os
+import os.path as osp
+import glob
+import json
+import argparse
+import numpy as np
+
+from .seti import SETI, cadence_to_image
+from .sample_index import SampleIndex
+
+
+'''
+    Consolidated store of one annotation file, written by `pack_seti_store`:
+
+        {name}_cadences.npy     (N, 6, 273, 256) raw cadences, float16 or float32
+        {name}_labels.npy       int64 (N, )
+        {name}_folds.npy        int64 (N, ), fold of each sample, 1 based, the
+                                same split as {root}/folds/val_fold_{k}.txt,
+                                0 for samples in no val fold, which are
+                                always used for training
+        {name}_meta.json        sample count, dtype, n_folds, count of fold 0
+                                (n_train_only) and per-channel min/max/mean/std
+                                of on (0) and off (1) channels
+
+    Cadences keep the file layout, so samples are converted by the same
+    `cadence_to_image` as the per-file reader.
+'''
+
+
+def read_folds(root, samples, folds_dir='folds'):
+    '''
+        fold of each sample, k for samples listed in {folds_dir}/val_fold_{k}.txt
+        and 0 for the others. gen_folds.py makes folds of len // n_folds
+        samples, the remaining samples are in every train fold and no val fold.
+    '''
+    pth_inds = {samples.get_path(i): i for i in range(len(samples))}
+    folds = np.zeros(len(samples), dtype=np.int64)
+    fold_files = glob.glob(osp.join(root, folds_dir, 'val_fold_*.txt'))
+    for pth in fold_files:
+        fold = int(osp.splitext(osp.basename(pth))[0].split('_')[-1])
+        fold_index = SampleIndex.from_ann_file(pth, root, sep=',')
+        for i in range(len(fold_index)):
+            folds[pth_inds[fold_index.get_path(i)]] = fold
+    return folds, len(fold_files)
+
+
+def pack_seti_store(root, ann_file='train_all.txt', save_root=None, name='train',
+        folds_dir='folds', dtype='float16', chunk_size=256):
+    '''
+        pack all cadences listed in {root}/{ann_file} into one memory-mapped
+        array, written chunk by chunk, with the fold of each sample read from
+        the existing fold files, so results are comparable with SETI folds
+    '''
+    if save_root is None: save_root = osp.join(root, 'store')
+    if not osp.exists(save_root): os.makedirs(save_root)
+    samples = SampleIndex.from_ann_file(osp.join(root, ann_file), root, sep=',')
+    n_samples = len(samples)
+    folds, n_folds = read_folds(root, samples, folds_dir)
+
+    shape = np.load(samples.get_path(0), mmap_mode='r').shape
+    cadences = np.lib.format.open_memmap(
+            osp.join(save_root, f'{name}_cadences.npy'), mode='w+',
+            dtype=np.dtype(dtype), shape=(n_samples, ) + shape)
+    chunk = np.empty((chunk_size, ) + shape, dtype=np.dtype(dtype))
+    ## per cadence min/max/sum/sum of squares, merged into on/off at last
+    v_min = np.full(shape[0], np.inf)
+    v_max = np.full(shape[0], -np.inf)
+    v_sum, v_sqsum = np.zeros(shape[0]), np.zeros(shape[0])
+    for start in range(0, n_samples, chunk_size):
+        end = min(start + chunk_size, n_samples)
+        for ind in range(start, end):
+            arr = np.load(samples.get_path(ind)).astype(np.float32)
+            v_min = np.minimum(v_min, arr.min(axis=(1, 2)))
+            v_max = np.maximum(v_max, arr.max(axis=(1, 2)))
+            v_sum += arr.sum(axis=(1, 2), dtype=np.float64)
+            v_sqsum += np.square(arr).sum(axis=(1, 2), dtype=np.float64)
+            chunk[ind - start] = arr
+        cadences[start:end] = chunk[:end - start]
+        cadences.flush()
+    del cadences
+
+    n_elem = n_samples * shape[1] * shape[2] * shape[0] // 2
+    stats = dict(min=[], max=[], mean=[], std=[])
+    for ch in range(2):
+        mean = v_sum[ch::2].sum() / n_elem
+        stats['min'].append(float(v_min[ch::2].min()))
+        stats['max'].append(float(v_max[ch::2].max()))
+        stats['mean'].append(float(mean))
+        stats['std'].append(float(np.sqrt(v_sqsum[ch::2].sum() / n_elem - mean ** 2)))
+
+    labels = samples.labels.astype(np.int64)
+    np.save(osp.join(save_root, f'{name}_labels.npy'), labels)
+    np.save(osp.join(save_root, f'{name}_folds.npy'), folds)
+    meta = dict(n_samples=n_samples, shape=list(shape), dtype=dtype,
+            n_folds=n_folds, n_train_only=int((folds == 0).sum()),
+            ann_file=ann_file, stats=stats)
+    with open(osp.join(save_root, f'{name}_meta.json'), 'w') as fw:
+        json.dump(meta, fw)
+    return meta
+
+
+class SETIStore(SETI):
+    '''
+        same as SETI, but reads cadences by index from the store generated by
+        `pack_seti_store`. Samples of `fold` are used for val, others for
+        train. With fold=None all samples are kept in both modes, and folds
+        are picked later by `get_fold_inds`. With norm_stats=True images are
+        normalized by the channel mean/std of the store instead of the
+        hardcoded constants.
+    '''
+
+    def __init__(self, root='./', mode='train', cropsize=224, binary=True,
+            store_root=None, name='train', fold=1, norm_stats=False):
+        self.store_root = osp.join(root, 'store') if store_root is None else store_root
+        self.name = name
+        self.fold = fold
+        self.norm_stats = norm_stats
+        self.cadences = None
+        super(SETIStore, self).__init__(root, mode, cropsize, binary)
+
+    def load_samples(self, root, mode):
+        with open(osp.join(self.store_root, f'{self.name}_meta.json'), 'r') as fr:
+            self.meta = json.load(fr)
+        self.labels = np.load(osp.join(self.store_root, f'{self.name}_labels.npy'))
+        self.folds = np.load(osp.join(self.store_root, f'{self.name}_folds.npy'))
+        assert self.folds.shape[0] == self.meta['n_samples']
+        if self.fold is None:
+            return np.arange(self.meta['n_samples'])
+        return self.select_fold(self.folds, self.fold)
+
+    def select_fold(self, folds, fold):
+        ## samples of fold 0 are in no val fold, so always in train
+        assert fold >= 1, 'folds are 1 based'
+        if self.mode == 'train':
+            inds = np.nonzero(folds != fold)[0]
+        elif self.mode == 'val':
+            inds = np.nonzero(folds == fold)[0]
+        return inds
+
+    def get_fold_inds(self, fold):
+        return self.select_fold(self.folds[self.samples], fold)
+
+    def get_norm_args(self):
+        if not self.norm_stats:
+            return super(SETIStore, self).get_norm_args()
+        stats = self.meta['stats']
+        return tuple(stats['mean']), tuple(stats['std']), 1.
+
+    def open_store(self):
+        # opened lazily, so that each dataloader worker maps the store by itself
+        self.cadences = np.load(osp.join(self.store_root,
+            f'{self.name}_cadences.npy'), mmap_mode='r')
+
+    def load_img(self, idx):
+        if self.cadences is None: self.open_store()
+        self.im_buf = cadence_to_image(self.cadences[self.samples[idx]], self.im_buf)
+        return self.im_buf
+
+    def get_label(self, idx):
+        return int(self.labels[self.samples[idx]])
+
+    def __getstate__(self):
+        # do not pickle memmaps into spawned workers
+        state = self.__dict__.copy()
+        state['cadences'] = None
+        return state
+
+
+if __name__ == "__main__":
+    # run from docker_train: python -m data.seti_store --root ./datasets/seti/
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--root', dest='root', type=str, default='./datasets/seti/')
+    parse.add_argument('--ann-file', dest='ann_file', type=str, default='train_all.txt')
+    parse.add_argument('--name', dest='name', type=str, default='train')
+    parse.add_argument('--folds-dir', dest='folds_dir', type=str, default='folds')
+    parse.add_argument('--dtype', dest='dtype', type=str, default='float16')
+    args = parse.parse_args()
+
+    meta = pack_seti_store(args.root, args.ann_file, name=args.name,
+            folds_dir=args.folds_dir, dtype=args.dtype)
+    print(json.dumps(meta['stats'], indent=2))
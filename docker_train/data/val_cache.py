@@ -0,0 +1,73 @@
+import os
+import os.path as osp
+import hashlib
+import numpy as np
+
+
+class ValCache(object):
+    '''
+        on-disk cache of resized and center cropped val images, stored as
+        uint8 (N, 3, H, W) in one memory-mapped .npy file.
+
+        The cache file is keyed by (crop_size, short_size, interpolation) and
+        the md5 of the annotation file, so editing val.txt or the val
+        transform points to a new file instead of reusing stale crops.
+        Samples are filled lazily by whichever dataloader worker reads them
+        first, after that a val sample costs one copy plus normalize.
+    '''
+
+    def __init__(self, cache_root, ann_file, n_samples, crop_size, short_size,
+            interpolation, mean, std):
+        with open(ann_file, 'rb') as fr:
+            md5 = hashlib.md5(fr.read()).hexdigest()[:16]
+        ch, cw = crop_size
+        name = f'val_c{ch}x{cw}_s{short_size}_i{interpolation}_{md5}'
+        self.im_pth = osp.join(cache_root, f'{name}.npy')
+        self.flag_pth = osp.join(cache_root, f'{name}.flags.npy')
+        if not osp.exists(cache_root): os.makedirs(cache_root, exist_ok=True)
+        self.create(self.im_pth, (n_samples, 3, ch, cw))
+        self.create(self.flag_pth, (n_samples, ))
+        self.ims, self.flags = None, None
+
+        # (im / 255 - mean) / std == im * scale + bias
+        mean = np.array(mean, dtype=np.float32).reshape(-1, 1, 1)
+        std = np.array(std, dtype=np.float32).reshape(-1, 1, 1)
+        self.scale = 1. / (255. * std)
+        self.bias = -mean / std
+
+    def create(self, pth, shape):
+        # written under a temporary name and linked into place, so that
+        # ranks creating the cache at the same time end up with one file
+        if osp.exists(pth): return
+        tmp_pth = f'{pth}.{os.getpid()}.tmp'
+        arr = np.lib.format.open_memmap(tmp_pth, mode='w+',
+                dtype=np.uint8, shape=shape)
+        del arr
+        try:
+            os.link(tmp_pth, pth)
+        except FileExistsError:
+            pass
+        os.remove(tmp_pth)
+
+    def open(self):
+        self.ims = np.load(self.im_pth, mmap_mode='r+')
+        self.flags = np.load(self.flag_pth, mmap_mode='r+')
+
+    def fetch(self, idx, read_func):
+        '''
+            read_func returns the cropped uint8 HWC image, it is only called
+            on cache miss
+        '''
+        if self.ims is None: self.open()
+        if not self.flags[idx]:
+            self.ims[idx] = read_func().transpose((2, 0, 1))
+            self.flags[idx] = 1
+        im = self.ims[idx].astype(np.float32)
+        im *= self.scale
+        im += self.bias
+        return im
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['ims'], state['flags'] = None, None
+        return state
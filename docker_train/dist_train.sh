@@ -42,21 +42,24 @@ cfg_file='./config/seti/timm_r18d.py'
 # cfg_file='./config/seti/resnet50_adamw_warmup10.py'
 cfg_file='./config/seti/timm_r18d.py'
 # cfg_file='./config/seti/timm_effnet_b1.py'
-for f_ind in $(seq 1 1 5);
-do
-    CURR=`pwd`
-    cd datasets/seti/
-    rm train.txt val.txt
-    ln -s folds/train_fold_$f_ind.txt ./train.txt
-    ln -s folds/val_fold_$f_ind.txt ./val.txt
-    cd $CURR
+## all folds in one process, writes res/model_final_{naive,ema}_k.pth and res/folds_summary.json
+python -m torch.distributed.launch --nproc_per_node=$N_GPUS --master_port=$PORT train.py --config $cfg_file --folds 1 2 3 4 5
 
-    python -m torch.distributed.launch --nproc_per_node=$N_GPUS --master_port=$PORT train.py --config $cfg_file
-    cd res
-    mv model_final_naive.pth model_final_naive_$f_ind.pth
-    mv model_final_ema.pth model_final_ema_$f_ind.pth
-    cd $CURR
-done
+# for f_ind in $(seq 1 1 5);
+# do
+#     CURR=`pwd`
+#     cd datasets/seti/
+#     rm train.txt val.txt
+#     ln -s folds/train_fold_$f_ind.txt ./train.txt
+#     ln -s folds/val_fold_$f_ind.txt ./val.txt
+#     cd $CURR
+#
+#     python -m torch.distributed.launch --nproc_per_node=$N_GPUS --master_port=$PORT train.py --config $cfg_file
+#     cd res
+#     mv model_final_naive.pth model_final_naive_$f_ind.pth
+#     mv model_final_ema.pth model_final_ema_$f_ind.pth
+#     cd $CURR
+# done
 
 
 # python -m torch.distributed.launch --nproc_per_node=$N_GPUS --master_port=$PORT train_cdata.py
@@ -1,11 +1,11 @@
 import os.path as osp
 import argparse
 import numpy as np
-from sklearn.metrics import roc_auc_score
 
-from cbl_models import build_model
+from cbl_models import build_model, fuse_model
 from config import set_cfg_from_file
 from data import get_dataset
+from metrics import build_metric_meter
 
 import torch
 import torch.distributed as dist
@@ -40,86 +40,46 @@ def parse_args():
 
 
 def evaluate(cfg, model, dl_eval):
-    metric_dict = eval_model(model, dl_eval, cfg.metric)
+    metric_args = getattr(cfg, 'metric_args', None)
+    metric_dict = eval_model(model, dl_eval, cfg.metric, metric_args)
     torch.cuda.empty_cache()
     return metric_dict
 
 
 @torch.no_grad()
-def eval_model(model, dl_eval, metric='acc'):
-    model.eval()
-    all_scores, all_gts = [], []
+def eval_model(models, dl_eval, metric='acc', metric_args=None):
+    '''
+        models can be one model or a list of models, each batch is loaded
+        once and fed to all of them. metric can be one metric name or a
+        list of names, metric_args maps metric name to its meter kwargs.
+        Returns one metric dict per model.
+    '''
+    single_model = not isinstance(models, (list, tuple))
+    if single_model: models = [models, ]
+    metrics = [metric, ] if isinstance(metric, str) else list(metric)
+    for model in models: model.eval()
+
+    meters = [[build_metric_meter(el, metric_args) for el in metrics]
+            for _ in models]
     for idx, (im, lb) in enumerate(dl_eval):
-        im = im.cuda()
-        lb = lb.cuda()
+        im = im.cuda(non_blocking=True)
+        lb = lb.cuda(non_blocking=True)
         #  lb = torch.zeros_like(lb)
-        logits = model(im)
-        if logits.size(1) == 1:
-            scores = logits.sigmoid() # score: (bs, 1), lb: (bs, 1)
-        else:
-            scores = torch.softmax(logits, dim=1)
-
-        all_scores.append(scores)
-        all_gts.append(lb)
-    all_scores = torch.cat(all_scores, dim=0)
-    all_gts = torch.cat(all_gts, dim=0)
-
-    metric_dict = {}
-    if metric == 'acc':
-        acc1, acc5 = compute_acc(all_scores, all_gts)
-        metric_dict['acc1'] = acc1
-        metric_dict['acc5'] = acc5
-    elif metric == 'roc_auc':
-        roc_auc = compute_roc_auc_score(all_scores, all_gts)
-        metric_dict['roc_auc'] = roc_auc
-    else:
-        raise NotImplementedError
-    return metric_dict
-
-
-@torch.no_grad()
-def compute_acc(all_scores, all_gts):
-    if all_scores.size(1) == 1: # binary
-        all_preds = all_scores.round().long()
-        n_correct = (all_gts == all_preds).sum()
-        n_samples = torch.tensor(all_gts.size(0)).cuda()
-        if dist.is_initialized():
-            dist.all_reduce(n_correct, dist.ReduceOp.SUM)
-            dist.all_reduce(n_samples, dist.ReduceOp.SUM)
-        acc1 = n_correct / n_samples
-        acc5 = 1.
-    else: # multi-class
-        all_preds = torch.argsort(-all_scores, dim=1)
-        match = (all_preds == all_gts.unsqueeze(1)).float()
-        n_correct_1 = match[:, :1].sum()
-        n_correct_5 = match[:, :5].sum()
-        n_samples = torch.tensor(match.size(0)).cuda()
-        if dist.is_initialized():
-            dist.all_reduce(n_correct_1, dist.ReduceOp.SUM)
-            dist.all_reduce(n_correct_5, dist.ReduceOp.SUM)
-            dist.all_reduce(n_samples, dist.ReduceOp.SUM)
-        acc1 = (n_correct_1 / n_samples).item()
-        acc5 = (n_correct_5 / n_samples).item()
-    return acc1, acc5
-
-
-@torch.no_grad()
-def compute_roc_auc_score(all_scores, all_gts):
-    if not all_scores.size(1) == 1: raise NotImplementedError
-
-    all_scores = all_scores.contiguous()
-    all_gt_gather = [torch.ones_like(all_gts)
-            for _ in range(dist.get_world_size())]
-    all_scores_gather = [torch.ones_like(all_scores)
-            for _ in range(dist.get_world_size())]
-    dist.all_gather(all_gt_gather, all_gts, async_op=False)
-    dist.all_gather(all_scores_gather, all_scores, async_op=False)
-    all_gt_gather = torch.cat(all_gt_gather, dim=0).squeeze()
-    all_scores_gather = torch.cat(all_scores_gather, dim=0).squeeze()
-    all_gt_gather = all_gt_gather.detach().cpu().numpy()
-    all_scores_gather = all_scores_gather.detach().cpu().numpy()
-    roc_auc = roc_auc_score(y_true=all_gt_gather, y_score=all_scores_gather)
-    return roc_auc
+        for model_meters, model in zip(meters, models):
+            logits = model(im)
+            if logits.size(1) == 1:
+                scores = logits.sigmoid() # score: (bs, 1), lb: (bs, 1)
+            else:
+                scores = torch.softmax(logits, dim=1)
+            for meter in model_meters: meter.update(scores, lb)
+
+    metric_dicts = []
+    for model_meters in meters:
+        metric_dict = {}
+        for meter in model_meters: metric_dict.update(meter.get())
+        metric_dicts.append(metric_dict)
+    if single_model: return metric_dicts[0]
+    return metric_dicts
 
 
 def main():
@@ -138,11 +98,7 @@ def main():
     #  model.load_state_dict(torch.load('./res/model_final.pth', map_location='cpu'))
     #  model.load_state_dict(sd, strict=True)
     model.load_states(sd)
-    model.eval()
-    if hasattr(model, 'fuse_block'):
-        model.fuse_block()
-    if hasattr(model, 'fuse_conv_bn'):
-        model.fuse_conv_bn()
+    fuse_model(model)
     model.cuda()
     #  if dist.get_rank() == 0:
     #      print(model)
@@ -0,0 +1,179 @@
+import os
+import os.path as osp
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from cbl_models import build_model, fuse_model
+from cbl_models.efficientnet_refactor import DropConnect
+from cbl_models.efficientnet_lite import DropConnect as DropConnectLite
+from cbl_models.bisenetv2 import RandomDepth
+from config import set_cfg_from_file
+
+
+'''
+    export a `get_states()` checkpoint to deployable artifacts:
+
+        python export.py --config config/repvgg_a1.py --ckpt ./res/model_final_ema.pth
+
+    writes {save_dir}/{name}.ts (frozen torchscript) and {save_dir}/{name}.onnx
+    (dynamic batch), checks both and the fused python model against the
+    unfused model of the checkpoint on cpu and prints
+    latency at batch 1 and 32.
+'''
+
+
+torch.set_grad_enabled(False)
+
+
+def parse_args():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--config', dest='config', type=str, default='resnet50.py',)
+    parse.add_argument('--ckpt', dest='ckpt_path', type=str, default='./res/model_final_naive.pth',)
+    parse.add_argument('--save-dir', dest='save_dir', type=str, default='./res/export',)
+    parse.add_argument('--name', dest='name', type=str, default=None,)
+    parse.add_argument('--in-chan', dest='in_chan', type=int, default=3,)
+    parse.add_argument('--size', dest='size', type=int, default=None,)
+    parse.add_argument('--opset', dest='opset', type=int, default=13,)
+    parse.add_argument('--no-onnx', dest='no_onnx', action='store_true',)
+    return parse.parse_args()
+
+
+## training only modules and what they are replaced by in the exported graph
+train_only_modules = {
+    DropConnect: nn.Identity,
+    DropConnectLite: nn.Identity,
+    RandomDepth: nn.Identity,
+    nn.Dropout: nn.Identity,
+}
+## custom autograd functions cannot be scripted or exported to onnx
+export_act_modules = {
+    'SwishV3': nn.SiLU,
+}
+
+
+class LogitsOnly(nn.Module):
+    '''
+        keep the first output of models that return several (logits and
+        dense/aux outputs), so the exported graph has a single output
+    '''
+
+    def __init__(self, model):
+        super(LogitsOnly, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        out = self.model(x)
+        if isinstance(out, (tuple, list)): out = out[0]
+        return out
+
+
+def strip_train_modules(model):
+    for name, mod in list(model.named_modules()):
+        if name == '': continue
+        new_mod = None
+        if type(mod) in train_only_modules:
+            new_mod = train_only_modules[type(mod)]()
+        elif type(mod).__name__ in export_act_modules:
+            new_mod = export_act_modules[type(mod).__name__]()
+        if new_mod is None: continue
+        parent_name, _, attr = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, attr, new_mod)
+    ## aux heads of BiSeNetV2 are only used by training losses
+    for mod in model.modules():
+        if not getattr(mod, 'output_aux', False): continue
+        mod.output_aux = False
+        for name, _ in list(mod.named_children()):
+            if name.startswith('aux'): delattr(mod, name)
+    return model
+
+
+def load_model(cfg_file, ckpt_path, fuse=True):
+    '''
+        build model from config, load a `get_states()` checkpoint, then strip
+        training only modules and fuse for inference on cpu. With
+        `fuse=False` the model is kept as trained, as reference of the outputs
+    '''
+    cfg = set_cfg_from_file(cfg_file)
+    model = build_model(cfg.model_args)
+    state = torch.load(ckpt_path, map_location='cpu')
+    model.load_states(state)
+    model.eval()
+    if fuse:
+        strip_train_modules(model)
+        fuse_model(model)
+    return cfg, LogitsOnly(model).eval()
+
+
+def export_torchscript(model, inten, save_pth):
+    script = torch.jit.trace(model, inten)
+    script = torch.jit.freeze(script)
+    torch.jit.save(script, save_pth)
+    return torch.jit.load(save_pth)
+
+
+def export_onnx(model, inten, save_pth, opset=13):
+    torch.onnx.export(model, inten, save_pth,
+            input_names=['input'], output_names=['logits'],
+            dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=opset, do_constant_folding=True)
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print('onnxruntime is not installed, skip running the onnx model')
+        return None
+    sess = ort.InferenceSession(save_pth, providers=['CPUExecutionProvider'])
+    return lambda x: torch.from_numpy(sess.run(None, {'input': x.numpy()})[0])
+
+
+def measure_latency(func, inten, n_iters=20):
+    for _ in range(3): func(inten)
+    t1 = time.time()
+    for _ in range(n_iters): func(inten)
+    return (time.time() - t1) / n_iters * 1e3
+
+
+def main():
+    args = parse_args()
+    cfg, model = load_model(args.config, args.ckpt_path)
+    name = args.name
+    if name is None: name = osp.splitext(osp.basename(args.config))[0]
+    size = args.size
+    if size is None: size = getattr(cfg, 'cropsize', 224)
+    if not osp.exists(args.save_dir): os.makedirs(args.save_dir)
+
+    inten = torch.randn(2, args.in_chan, size, size)
+    runners = [('eager', model), ]
+    ts_pth = osp.join(args.save_dir, f'{name}.ts')
+    runners.append(('torchscript', export_torchscript(model, inten, ts_pth)))
+    print(f'saved: {ts_pth}')
+    if not args.no_onnx:
+        onnx_pth = osp.join(args.save_dir, f'{name}.onnx')
+        ort_runner = export_onnx(model, inten, onnx_pth, args.opset)
+        print(f'saved: {onnx_pth}')
+        if not ort_runner is None: runners.append(('onnxruntime', ort_runner))
+
+    ## parity on a batch size other than the traced one, to check dynamic
+    ## batch, against the unfused model of the checkpoint, so that errors of
+    ## stripping and fusion are caught as well
+    _, ref_model = load_model(args.config, args.ckpt_path, fuse=False)
+    inten = torch.randn(5, args.in_chan, size, size)
+    out = ref_model(inten)
+    tol = 1e-3 * max(1., out.abs().max().item())
+    for rname, runner in runners:
+        diff = (runner(inten) - out).abs().max().item()
+        print(f'{rname}: max abs diff to the unfused model {diff:.2e}')
+        assert diff <= tol, f'{rname} output does not match the unfused model'
+
+    for bs in (1, 32):
+        inten = torch.randn(bs, args.in_chan, size, size)
+        for rname, runner in runners:
+            t = measure_latency(runner, inten, n_iters=20 if bs == 1 else 5)
+            print(f'{rname}, batch {bs}: {t:.2f} ms, {bs / t * 1e3:.1f} im/s')
+
+
+if __name__ == '__main__':
+    main()
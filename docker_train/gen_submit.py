@@ -10,6 +10,7 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 
 from cbl_models import build_model
+from data.seti import read_cadence
 from config import set_cfg_from_file
 
 import torch
@@ -87,6 +88,7 @@ class InferDataset(Dataset):
     def __init__(self):
         super(InferDataset, self).__init__()
         self.fids = list(fid_pths.keys())
+        self.im_buf = None
         self.trans = A.Compose([
             A.Resize(p=1., height=cropsize, width=cropsize),
             A.Normalize(mean=(0.4),std=(0.2),max_pixel_value=180.,p=1.),
@@ -94,13 +96,9 @@ class InferDataset(Dataset):
         ])
 
     def readimg(self, impth):
-        im_on = np.load(impth)[[0, 2, 4]] # (3, 273, 256)
-        im_off = np.load(impth)[[1, 3, 5]] # (3, 273, 256)
-        im_on = np.vstack(im_on).T[..., np.newaxis] # (256, 819, 1)
-        im_off = np.vstack(im_off).T[..., np.newaxis] # (256, 819, 1)
-        im = np.concatenate([im_on, im_off], axis=2)
-        im = im.astype('f') # (256, 819, 2)
-        return im
+        # buffer is reused, self.trans starts with Resize which copies
+        self.im_buf = read_cadence(impth, self.im_buf)
+        return self.im_buf
 
     #  def readimg(self, impth):
     #      im = np.load(impth)[[0, 2, 4]] # (3, 273, 256)
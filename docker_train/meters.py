@@ -2,11 +2,14 @@
 import time
 import datetime
 
+import torch
+
 
 class TimeMeter(object):
 
     def __init__(self, max_iter):
         self.iter = 0
+        self.start_iter = 0
         self.max_iter = max_iter
         self.st = time.time()
         self.global_st = self.st
@@ -19,7 +22,7 @@ class TimeMeter(object):
         self.curr = time.time()
         interv = self.curr - self.st
         global_interv = self.curr - self.global_st
-        eta = int((self.max_iter-self.iter) * (global_interv / (self.iter+1)))
+        eta = int((self.max_iter-self.iter) * (global_interv / (self.iter-self.start_iter+1)))
         eta = str(datetime.timedelta(seconds=eta))
         self.st = self.curr
         return interv, eta
@@ -30,6 +33,7 @@ class TimeMeter(object):
 
     def load_state_dict(self, state):
         self.iter = state['iter']
+        self.start_iter = self.iter
 
 
 class AvgMeter(object):
@@ -55,3 +59,57 @@ class AvgMeter(object):
     def load_state_dict(self, state):
         self.seq = state['curr_seq']
         self.global_seq = state['global_seq']
+
+
+class DeviceAvgMeter(object):
+    '''
+        running average of tensors on their own device: window and global
+        sums are accumulated by in-place adds, counts are kept on host, so
+        `update()` never waits for the device, only `get()` does. This only
+        concerns the meter, other parts of a training step may still sync.
+    '''
+
+    def __init__(self):
+        self.sums = None # window sum, global sum
+        self.count, self.global_count = 0, 0
+
+    def update(self, val):
+        val = val.detach()
+        if self.sums is None:
+            self.sums = torch.zeros(2, dtype=torch.float64, device=val.device)
+        elif self.sums.device != val.device: # loaded from a state dict
+            self.sums = self.sums.to(val.device)
+        self.sums.add_(val.double())
+        self.count += 1
+        self.global_count += 1
+
+    def get(self):
+        win_sum, global_sum = self.sums.tolist()
+        avg = win_sum / max(self.count, 1)
+        global_avg = global_sum / max(self.global_count, 1)
+        self.sums[0].zero_()
+        self.count = 0
+        return avg, global_avg
+
+    def state_dict(self):
+        sums = [0., 0.] if self.sums is None else self.sums.tolist()
+        state = dict(sums=sums, count=self.count, global_count=self.global_count)
+        return state
+
+    def load_state_dict(self, state):
+        self.sums = torch.tensor(state['sums'], dtype=torch.float64)
+        self.count = state['count']
+        self.global_count = state['global_count']
+
+
+if __name__ == '__main__':
+    ## host syncs of the training step are counted in tests/test_train_step.py
+    n_iters, print_freq = 1000, 50
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    meter = DeviceAvgMeter()
+    losses = torch.rand(n_iters, device=device)
+    for it in range(n_iters):
+        meter.update(losses[it] * 2.)
+        if (it + 1) % print_freq == 0: meter.get()
+    _, global_avg = meter.get()
+    assert abs(global_avg - losses.double().mul(2.).mean().item()) < 1e-6
@@ -12,22 +12,28 @@ class CutMixer(object):
     def __call__(self, ims, lbs):
         assert ims.size(0) == lbs.size(0)
 
-        bs = ims.size(0)
-        #  lam = self.beta_generator.sample([bs, 1, 1, 1]).cuda()
-        lam = self.beta_generator.sample([bs, ]).cuda()
+        bs, device = ims.size(0), ims.device
+        #  lam = self.beta_generator.sample([bs, 1, 1, 1])
+        lam = self.beta_generator.sample([bs, ]).to(device, non_blocking=True)
         #  lam = torch.where(lam > (1. - lam), lam, (1. - lam))
-        indices = torch.randperm(bs).tolist()
+        indices = torch.randperm(bs, device=device)
 
         H, W = ims.size(2), ims.size(3)
         ratio = (1. - lam).sqrt()
         h, w = (H * ratio).long(), (W * ratio).long()
-        ch, cw = torch.randint(0, H, (bs, )).cuda(), torch.randint(0, W, (bs, )).cuda()
-        x1 = (ch - h.floor_divide(2)).clamp(0, H)
-        y1 = (cw - w.floor_divide(2)).clamp(0, W)
-        x2 = (ch + h.floor_divide(2)).clamp(0, H)
-        y2 = (cw + w.floor_divide(2)).clamp(0, W)
-        for ii, (xx1, xx2, yy1, yy2) in enumerate(zip(x1, x2, y1, y2)):
-            ims[ii, :, xx1:xx2, yy1:yy2] = ims[indices[ii], :, xx1:xx2, yy1:yy2]
+        ch = torch.randint(0, H, (bs, ), device=device)
+        cw = torch.randint(0, W, (bs, ), device=device)
+        x1 = (ch - h // 2).clamp(0, H)
+        y1 = (cw - w // 2).clamp(0, W)
+        x2 = (ch + h // 2).clamp(0, H)
+        y2 = (cw + w // 2).clamp(0, W)
+
+        ## (bs, 1, H, W) box mask from broadcast comparisons, one blend
+        rows = torch.arange(H, device=device).view(1, 1, H, 1)
+        cols = torch.arange(W, device=device).view(1, 1, 1, W)
+        mask = ((rows >= x1.view(-1, 1, 1, 1)) & (rows < x2.view(-1, 1, 1, 1))
+                & (cols >= y1.view(-1, 1, 1, 1)) & (cols < y2.view(-1, 1, 1, 1)))
+        ims = torch.where(mask, ims[indices], ims)
         lam = 1. - ((x2 - x1) * (y2 - y1)).float().div(float(H * W))
 
         lam = lam.view(-1, 1)
@@ -58,3 +64,29 @@ class CutMixer(object):
     #      lbs = lam * lbs + (1. - lam) * lbs[indices]
     #
     #      return ims, lbs
+
+
+if __name__ == '__main__':
+    import time
+
+    ## boxes of the batched version match the per-sample patch copy
+    torch.manual_seed(123)
+    ims, lbs = torch.randn(8, 3, 32, 48), torch.eye(8)
+    cutmixer = CutMixer(1.)
+    torch.manual_seed(0)
+    ims_mix, lbs_mix = cutmixer(ims.clone(), lbs)
+    diff = (ims_mix != ims).any(dim=1)
+    for ii in range(ims.size(0)):
+        area = diff[ii].sum().item()
+        assert abs((1. - lbs_mix[ii, ii].item()) * 32 * 48 - area) <= 1e-3 or area == 0
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for bs in (32, 128, 256):
+        ims = torch.randn(bs, 3, 224, 224, device=device)
+        lbs = torch.randn(bs, 1000, device=device)
+        for _ in range(3): cutmixer(ims, lbs)
+        if device == 'cuda': torch.cuda.synchronize()
+        t1 = time.time()
+        for _ in range(20): cutmixer(ims, lbs)
+        if device == 'cuda': torch.cuda.synchronize()
+        print(f'{device}, bs: {bs}, {(time.time() - t1) / 20 * 1e3:.3f} ms/batch')
@@ -4,6 +4,10 @@ import torch
 
 
 class MixUper(object):
+    '''
+        ims are mixed in place with their permuted partners, the only full
+        size temporary is the gathered partner batch
+    '''
 
     def __init__(self, alpha, use_batch=True):
         self.beta_generator = torch.distributions.beta.Beta(alpha, alpha)
@@ -13,18 +17,49 @@ class MixUper(object):
     def __call__(self, ims, lbs):
         assert ims.size(0) == lbs.size(0)
 
-        bs = ims.size(0)
+        bs, device = ims.size(0), ims.device
+        ## lam is drawn before indices, same order as the out of place version
         if self.use_batch:
-            lam = self.beta_generator.sample([bs, 1, 1, 1]).cuda()
+            lam = self.beta_generator.sample([bs, 1, 1, 1])
             lam = torch.where(lam > (1. - lam), lam, (1. - lam))
-            indices = torch.randperm(bs)
-            ims = lam * ims + (1. - lam) * ims[indices]
+            indices = torch.randperm(bs, device=device)
+            lam = lam.to(device, non_blocking=True)
+            ## lerp_(end, w): ims + w * (end - ims) == lam * ims + (1 - lam) * end
+            ims.lerp_(ims[indices], (1. - lam).to(ims.dtype))
             lam = lam.view(-1, 1)
-            lbs = lam * lbs + (1. - lam) * lbs[indices]
+            lbs = lbs.lerp(lbs[indices], (1. - lam).to(lbs.dtype))
         else:
-            lam = self.beta_generator.sample().cuda()
-            indices = torch.randperm(bs)
-            ims = lam * ims + (1. - lam) * ims[indices]
-            lbs = lam * lbs + (1. - lam) * lbs[indices]
+            lam = self.beta_generator.sample().item()
+            indices = torch.randperm(bs, device=device)
+            ims.lerp_(ims[indices], 1. - lam)
+            lbs = lbs.lerp(lbs[indices], 1. - lam)
 
         return ims.detach(), lbs.detach()
+
+
+if __name__ == '__main__':
+
+    ## compare with lam * ims + (1 - lam) * ims[indices]
+    for use_batch in (True, False):
+        mixuper = MixUper(0.4, use_batch=use_batch)
+        ims, lbs = torch.randn(16, 3, 32, 32), torch.eye(16)
+        torch.manual_seed(0)
+        ims_mix, lbs_mix = mixuper(ims.clone(), lbs)
+        ## recover lam and partner of each sample from the mixed labels
+        for ii in range(16):
+            lam = lbs_mix[ii, ii].item()
+            others = lbs_mix[ii].clone()
+            others[ii] = 0
+            jj = others.argmax().item() if lam < 1. else ii
+            ref = lam * ims[ii] + (1. - lam) * ims[jj]
+            assert torch.allclose(ims_mix[ii], ref, atol=1e-5)
+
+    if torch.cuda.is_available():
+        mixuper = MixUper(0.4)
+        ims = torch.randn(256, 3, 224, 224).cuda()
+        lbs = torch.randn(256, 1000).cuda()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        mixuper(ims, lbs)
+        extra = torch.cuda.max_memory_allocated() - base
+        print(f'extra peak memory: {extra / ims.numel() / ims.element_size():.2f} batches')
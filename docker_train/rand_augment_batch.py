@@ -0,0 +1,417 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from rand_augment_cv2 import (OP_NAMES, MAX_LEVEL, translate_const,
+        cutout_const, replace_value)
+
+
+'''
+    Batched version of rand_augment_cv2.RandomAugment. The ops work on NCHW
+    float tensors holding values in [0, 255], on cpu or gpu, and take one
+    magnitude per sample. Each op rounds or truncates to integer values the
+    same way as its cv2/numpy counterpart, so results match the per-image
+    ops up to interpolation rounding.
+'''
+
+
+### transform functions, x: (n, C, H, W) float, params: (n, )
+def _view(param):
+    return param.view(-1, 1, 1, 1)
+
+
+def autocontrast_func(x):
+    low = x.amin(dim=(2, 3), keepdim=True)
+    high = x.amax(dim=(2, 3), keepdim=True)
+    scale = 255. / (high - low).clamp(min=1)
+    out = (x * scale - low * scale).clamp(0, 255).floor()
+    return torch.where(high > low, out, x)
+
+
+def equalize_func(x):
+    n, C, H, W = x.size()
+    inds = x.long().reshape(n * C, H * W)
+    hist = torch.zeros(n * C, 256, dtype=torch.long, device=x.device)
+    hist.scatter_add_(1, inds, torch.ones_like(inds))
+    # pixels of the last non-zero bin are excluded from step
+    last = 255 - (hist.flip(dims=(1, )) > 0).long().argmax(dim=1, keepdim=True)
+    step = (H * W - hist.gather(1, last)) // 255
+    n_acc = torch.cat([step // 2, hist[:, :-1]], dim=1)
+    table = (n_acc.cumsum(dim=1) // step.clamp(min=1)).clamp(0, 255)
+    out = torch.where(step > 0, table.gather(1, inds), inds)
+    return out.view(n, C, H, W).float()
+
+
+def invert_func(x):
+    return 255. - x
+
+
+def posterize_func(x, bits):
+    q = _view(2. ** (8 - bits))
+    return (x / q).floor() * q
+
+
+def solarize_func(x, thresh):
+    return torch.where(x < _view(thresh), x, 255. - x)
+
+
+def solarized_add_func(x, addition, thresh=128):
+    return torch.where(x < thresh, (x + _view(addition)).clamp(max=255), x)
+
+
+def color_func(x, factor):
+    degenerate = torch.tensor([0.114, 0.587, 0.299], device=x.device)
+    M = torch.tensor([
+            [0.886, -0.114, -0.114],
+            [-0.587, 0.413, -0.587],
+            [-0.299, -0.299, 0.701]], device=x.device)
+    M = M[None] * factor.view(-1, 1, 1) + degenerate.view(1, 3, 1)
+    out = torch.einsum('nihw,nij->njhw', x, M)
+    return out.clamp(0, 255).floor()
+
+
+def contrast_func(x, factor):
+    weight = torch.tensor([0.114, 0.587, 0.299], device=x.device)
+    mean = (x.mean(dim=(2, 3)) * weight).sum(dim=1)
+    mean, factor = _view(mean), _view(factor)
+    return ((x - mean) * factor + mean).clamp(0, 255).floor()
+
+
+def brightness_func(x, factor):
+    return (x * _view(factor)).clamp(0, 255).floor()
+
+
+def sharpness_func(x, factor):
+    n, C, H, W = x.size()
+    kernel = torch.ones(1, 1, 3, 3, device=x.device)
+    kernel[0, 0, 1, 1] = 5
+    kernel /= 13
+    # cv2.filter2D pads with BORDER_REFLECT_101
+    degenerate = F.conv2d(F.pad(x.reshape(n * C, 1, H, W), (1, 1, 1, 1),
+        mode='reflect'), kernel).view(n, C, H, W)
+    factor = _view(factor)
+    out = (degenerate * (1. - factor) + x * factor).round().clamp(0, 255)
+    # same border values as sharpness_func in rand_augment_cv2
+    out[:, :, 0, :] = x[:, :, 0, :]
+    out[:, :, -1, :] = x[:, :, -1, :]
+    out[:, :, :, 0] = x[:, :, -1, 0:1]
+    out[:, :, :, -1] = x[:, :, -1, -1:]
+    return out
+
+
+def warp_affine(x, M, fill):
+    '''
+        same as cv2.warpAffine with INTER_LINEAR and constant border, M is
+        the (n, 2, 3) forward matrix in pixel coordinates
+    '''
+    n, C, H, W = x.size()
+    A, t = M[:, :, :2], M[:, :, 2:]
+    A_inv = torch.inverse(A)
+    t_inv = -A_inv @ t
+    ys, xs = torch.meshgrid(
+            torch.arange(H, device=x.device, dtype=x.dtype),
+            torch.arange(W, device=x.device, dtype=x.dtype), indexing='ij')
+    coords = torch.stack([xs.reshape(-1), ys.reshape(-1)], dim=0)
+    src = A_inv @ coords[None] + t_inv # (n, 2, H * W)
+    grid = torch.stack([
+        src[:, 0] * (2. / max(W - 1, 1)) - 1.,
+        src[:, 1] * (2. / max(H - 1, 1)) - 1.], dim=2).view(n, H, W, 2)
+    fill = torch.tensor(fill[:C], device=x.device, dtype=x.dtype).view(1, C, 1, 1)
+    out = F.grid_sample(x - fill, grid, mode='bilinear',
+            padding_mode='zeros', align_corners=True) + fill
+    return out.round().clamp(0, 255)
+
+
+def affine_matrix(a, b, c, d, tx, ty):
+    M = torch.stack([a, b, tx, c, d, ty], dim=1)
+    return M.view(-1, 2, 3)
+
+
+def rotate_matrix(x, degree):
+    H, W = x.size(2), x.size(3)
+    cx, cy = W / 2, H / 2
+    theta = degree * math.pi / 180.
+    alpha, beta = theta.cos(), theta.sin()
+    return affine_matrix(alpha, beta, -beta, alpha,
+            (1. - alpha) * cx - beta * cy, beta * cx + (1. - alpha) * cy)
+
+
+def shear_x_matrix(x, factor):
+    one, zero = torch.ones_like(factor), torch.zeros_like(factor)
+    return affine_matrix(one, factor, zero, one, zero, zero)
+
+
+def shear_y_matrix(x, factor):
+    one, zero = torch.ones_like(factor), torch.zeros_like(factor)
+    return affine_matrix(one, zero, factor, one, zero, zero)
+
+
+def translate_x_matrix(x, offset):
+    one, zero = torch.ones_like(offset), torch.zeros_like(offset)
+    return affine_matrix(one, zero, zero, one, -offset, zero)
+
+
+def translate_y_matrix(x, offset):
+    one, zero = torch.ones_like(offset), torch.zeros_like(offset)
+    return affine_matrix(one, zero, zero, one, zero, -offset)
+
+
+def rotate_func(x, degree, fill=(0, 0, 0)):
+    return warp_affine(x, rotate_matrix(x, degree), fill)
+
+
+def shear_x_func(x, factor, fill=(0, 0, 0)):
+    return warp_affine(x, shear_x_matrix(x, factor), fill)
+
+
+def shear_y_func(x, factor, fill=(0, 0, 0)):
+    return warp_affine(x, shear_y_matrix(x, factor), fill)
+
+
+def translate_x_func(x, offset, fill=(0, 0, 0)):
+    return warp_affine(x, translate_x_matrix(x, offset), fill)
+
+
+def translate_y_func(x, offset, fill=(0, 0, 0)):
+    return warp_affine(x, translate_y_matrix(x, offset), fill)
+
+
+def cutout_func(x, pad_size, replace=(0, 0, 0)):
+    n, C, H, W = x.size()
+    rh, rw = torch.rand(2, n, device=x.device)
+    ch, cw = (rh * H).floor(), (rw * W).floor()
+    x1, x2 = _view(ch - pad_size), _view(ch + pad_size)
+    y1, y2 = _view(cw - pad_size), _view(cw + pad_size)
+    rows = torch.arange(H, device=x.device).view(1, 1, H, 1)
+    cols = torch.arange(W, device=x.device).view(1, 1, 1, W)
+    mask = (rows >= x1) & (rows < x2) & (cols >= y1) & (cols < y2)
+    replace = torch.tensor(replace[:C], device=x.device, dtype=x.dtype).view(1, C, 1, 1)
+    return torch.where(mask, replace, x)
+
+
+func_dict = {
+    'AutoContrast': autocontrast_func,
+    'Equalize': equalize_func,
+    'Invert': invert_func,
+    'Rotate': rotate_func,
+    'Posterize': posterize_func,
+    'Solarize': solarize_func,
+    'Color': color_func,
+    'Contrast': contrast_func,
+    'Brightness': brightness_func,
+    'Sharpness': sharpness_func,
+    'ShearX': shear_x_func,
+    'ShearY': shear_y_func,
+    'TranslateX': translate_x_func,
+    'TranslateY': translate_y_func,
+    'Cutout': cutout_func,
+    'SolarizeAdd': solarized_add_func,
+}
+
+## geometric ops, merged into one warp per round
+matrix_dict = {
+    'Rotate': rotate_matrix,
+    'ShearX': shear_x_matrix,
+    'ShearY': shear_y_matrix,
+    'TranslateX': translate_x_matrix,
+    'TranslateY': translate_y_matrix,
+}
+
+
+### args functions, same mapping as rand_augment_cv2, level: (n, )
+def random_sign(level):
+    return torch.where(torch.rand_like(level) > 0.5, -level, level)
+
+
+def enhance_level_to_args(level):
+    return ((level / MAX_LEVEL) * 1.8 + 0.1, )
+
+
+def shear_level_to_args(level):
+    return (random_sign((level / MAX_LEVEL) * 0.3), replace_value)
+
+
+def translate_level_to_args(level):
+    return (random_sign((level / MAX_LEVEL) * float(translate_const)), replace_value)
+
+
+def cutout_level_to_args(level):
+    return (((level / MAX_LEVEL) * cutout_const).floor(), replace_value)
+
+
+def none_level_to_args(level):
+    return ()
+
+
+def rotate_level_to_args(level):
+    return (random_sign((level / MAX_LEVEL) * 30), replace_value)
+
+
+def posterize_level_to_args(level):
+    return (((level / MAX_LEVEL) * 4).floor(), )
+
+
+def solarize_level_to_args(level):
+    return (((level / MAX_LEVEL) * 256).floor(), )
+
+
+def solarize_add_level_to_args(level):
+    return (((level / MAX_LEVEL) * 110).floor(), 128)
+
+
+arg_dict = {
+    'AutoContrast': none_level_to_args,
+    'Equalize': none_level_to_args,
+    'Invert': none_level_to_args,
+    'Rotate': rotate_level_to_args,
+    'Posterize': posterize_level_to_args,
+    'Solarize': solarize_level_to_args,
+    'Color': enhance_level_to_args,
+    'Contrast': enhance_level_to_args,
+    'Brightness': enhance_level_to_args,
+    'Sharpness': enhance_level_to_args,
+    'ShearX': shear_level_to_args,
+    'ShearY': shear_level_to_args,
+    'TranslateX': translate_level_to_args,
+    'TranslateY': translate_level_to_args,
+    'Cutout': cutout_level_to_args,
+    'SolarizeAdd': solarize_add_level_to_args,
+}
+
+
+def apply_ops(x, op_inds, mags):
+    '''
+        apply op OP_NAMES[op_inds[i]] with magnitude mags[i] to x[i], in
+        place on x. op_inds is a cpu long tensor, -1 for no op, mags is on
+        the device of x. Samples are grouped by op, so each op only runs on
+        the samples that drew it, and all geometric ops share one warp.
+    '''
+    counts = torch.bincount(op_inds + 1, minlength=len(OP_NAMES) + 1).tolist()
+    # one small copy to the device, grouping is done on host without sync
+    perm = op_inds.argsort().to(x.device, non_blocking=True)
+    start = counts[0]
+    warp_inds, warp_Ms = [], []
+    for name, count in zip(OP_NAMES, counts[1:]):
+        if count == 0: continue
+        inds = perm[start:start + count]
+        start += count
+        args = arg_dict[name](mags.index_select(0, inds))
+        if name in matrix_dict:
+            warp_inds.append(inds)
+            warp_Ms.append(matrix_dict[name](x, args[0]))
+            continue
+        x.index_copy_(0, inds, func_dict[name](x.index_select(0, inds), *args))
+    if len(warp_inds) > 0:
+        inds, M = torch.cat(warp_inds), torch.cat(warp_Ms)
+        x.index_copy_(0, inds, warp_affine(x.index_select(0, inds), M, replace_value))
+    return x
+
+
+class BatchRandomAugment(object):
+    '''
+        same N and M semantics as rand_augment_cv2.RandomAugment: each sample
+        draws N ops, each op has a magnitude drawn from gauss(M, 0.5) and is
+        applied with prob 0.5.
+        Op choices are drawn on cpu, so samples can be grouped by op without
+        a host-device sync, magnitudes are drawn on the device of the batch.
+        The input batch is never modified.
+    '''
+
+    def __init__(self, N, M, prob=0.5):
+        self.N = N
+        self.M = M
+        self.prob = prob
+
+    @torch.no_grad()
+    def __call__(self, ims):
+        '''
+            ims: (B, C, H, W) uint8 or float tensor in range of [0, 255]
+        '''
+        dtype, device = ims.dtype, ims.device
+        x = ims.to(torch.float32, copy=True)
+        bs = x.size(0)
+        for _ in range(self.N):
+            op_inds = torch.randint(0, len(OP_NAMES), (bs, ))
+            op_inds[torch.rand(bs) > self.prob] = -1
+            mags = (torch.randn(bs, device=device) * 0.5 + self.M).clamp(0, MAX_LEVEL)
+            apply_ops(x, op_inds, mags)
+        if dtype == torch.uint8: x = x.to(dtype)
+        return x
+
+
+if __name__ == '__main__':
+    import time
+    import numpy as np
+    import cv2
+    import rand_augment_cv2 as RA
+
+    ## parity with rand_augment_cv2 ops, on smooth random images
+    H, W = 224, 200
+    ims = []
+    for _ in range(4):
+        im = np.random.randint(0, 256, (H // 8, W // 8, 3), dtype=np.uint8)
+        ims.append(cv2.resize(im, (W, H), interpolation=cv2.INTER_CUBIC))
+    x = torch.from_numpy(np.stack(ims).transpose(0, 3, 1, 2)).float()
+
+    ## pixel ops differ by at most 1 from float rounding, geometric ops
+    ## also differ where bilinear weights are rounded differently
+    def check(name, args, cv_args, x=x):
+        level_args = [torch.full((x.size(0), ), float(el)) for el in args]
+        out = func_dict[name](x, *level_args)
+        out_cv = np.stack([RA.func_dict[name](im, *cv_args) for im in ims])
+        out_cv = torch.from_numpy(out_cv.transpose(0, 3, 1, 2)).float()
+        diff = (out - out_cv).abs()
+        print(f'{name}: max diff {diff.max().item()}, '
+              f'ratio of diff > 1: {(diff > 1).float().mean().item():.6f}')
+        assert diff.max().item() <= 1, name
+
+    check('AutoContrast', (), ())
+    check('Equalize', (), ())
+    check('Invert', (), ())
+    check('Posterize', (3, ), (3, ))
+    check('Solarize', (70, ), (70, ))
+    check('SolarizeAdd', (60, ), (60, ))
+    check('Color', (0.6, ), (0.6, ))
+    check('Contrast', (1.6, ), (1.6, ))
+    check('Brightness', (1.3, ), (1.3, ))
+    check('Sharpness', (0.3, ), (0.3, ))
+    for name, val in (('Rotate', 20.), ('ShearX', 0.2), ('ShearY', -0.2),
+            ('TranslateX', 40.), ('TranslateY', -30.)):
+        level_args = (torch.full((x.size(0), ), val), )
+        out = func_dict[name](x, *level_args, fill=replace_value)
+        out_cv = np.stack([RA.func_dict[name](im, val, replace_value) for im in ims])
+        out_cv = torch.from_numpy(out_cv.transpose(0, 3, 1, 2)).float()
+        diff = (out - out_cv).abs()
+        print(f'{name}: max diff {diff.max().item()}, '
+              f'ratio of diff > 1: {(diff > 1).float().mean().item():.6f}')
+        assert (diff > 1).float().mean().item() <= 1e-2, name
+
+    ## float input is left untouched
+    x_in = x.clone()
+    BatchRandomAugment(2, 9)(x)
+    assert torch.equal(x, x_in)
+
+    ## throughput, per-image cv2 ops versus batch ops
+    bs, n_iters = 128, 10
+    ims = np.random.randint(0, 256, (bs, 224, 224, 3), dtype=np.uint8)
+    ra_cv = RA.RandomAugment(2, 9)
+    t1 = time.time()
+    for _ in range(n_iters):
+        for im in ims: ra_cv(im)
+    t2 = time.time()
+    ips_cv = bs * n_iters / (t2 - t1)
+    print(f'cv2 per-image: {ips_cv:.2f} images/sec')
+
+    ra_batch = BatchRandomAugment(2, 9)
+    devices = ['cpu', ] + (['cuda', ] if torch.cuda.is_available() else [])
+    for device in devices:
+        x = torch.from_numpy(ims.transpose(0, 3, 1, 2).copy()).to(device)
+        ra_batch(x)
+        if device == 'cuda': torch.cuda.synchronize()
+        t1 = time.time()
+        for _ in range(n_iters): ra_batch(x)
+        if device == 'cuda': torch.cuda.synchronize()
+        t2 = time.time()
+        ips = bs * n_iters / (t2 - t1)
+        print(f'batch on {device}: {ips:.2f} images/sec, {ips / ips_cv:.2f}x of cv2')
@@ -1,4 +1,5 @@
 import random
+import functools
 
 import cv2
 import numpy as np
@@ -92,7 +93,7 @@ def posterize_func(img, bits):
     '''
         same output as PIL.ImageOps.posterize
     '''
-    out = np.bitwise_and(img, np.uint8(255 << (8 - bits)))
+    out = np.bitwise_and(img, np.uint8((255 << (8 - bits)) & 255))
     return out
 
 
@@ -100,9 +101,7 @@ def solarize_func(img, thresh=128):
     '''
         same output as PIL.ImageOps.posterize
     '''
-    table = np.array([el if el < thresh else 255 - el for el in range(256)])
-    table = table.clip(0, 255).astype(np.uint8)
-    out = table[img]
+    out = solarize_table(thresh)[img]
     return out
 
 
@@ -133,11 +132,7 @@ def contrast_func(img, factor):
         same output as PIL.ImageEnhance.Contrast
     '''
     mean = np.sum(np.mean(img, axis=(0, 1)) * np.array([0.114, 0.587, 0.299]))
-    table = np.array([(
-        el - mean) * factor + mean
-        for el in range(256)
-    ]).clip(0, 255).astype(np.uint8)
-    out = table[img]
+    out = contrast_table(mean, factor)[img]
     return out
 
 
@@ -232,10 +227,7 @@ def cutout_func(img, pad_size, replace=(0, 0, 0)):
 
 
 def solarized_add_func(img, addition=0, thresh=128):
-    table = np.array([
-        el + addition if el < thresh else el for el in range(256)
-    ]).clip(0, 255).astype(np.uint8)
-    out = table[img]
+    out = solarized_add_table(addition, thresh)[img]
     return out
 
 
@@ -259,6 +251,147 @@ func_dict = {
 }
 
 
+### lookup tables of per-pixel intensity ops
+## image independent tables are memoized, float magnitudes are quantized
+## so that the cache can be hit
+def quantize(val, step=1e-3):
+    return round(round(val / step) * step, 6)
+
+
+def _readonly(table):
+    table.flags.writeable = False
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def invert_table():
+    return _readonly(255 - np.arange(256, dtype=np.uint8))
+
+
+@functools.lru_cache(maxsize=None)
+def posterize_table(bits):
+    mask = np.uint8((255 << (8 - bits)) & 255)
+    return _readonly(np.bitwise_and(np.arange(256, dtype=np.uint8), mask))
+
+
+@functools.lru_cache(maxsize=None)
+def solarize_table(thresh=128):
+    table = np.arange(256)
+    table = np.where(table < thresh, table, 255 - table)
+    return _readonly(table.clip(0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=None)
+def solarized_add_table(addition=0, thresh=128):
+    table = np.arange(256)
+    table = np.where(table < thresh, table + addition, table)
+    return _readonly(table.clip(0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=4096)
+def brightness_table(factor):
+    table = (np.arange(256, dtype=np.float32) * factor).clip(0, 255)
+    return _readonly(table.astype(np.uint8))
+
+
+def contrast_table(mean, factor):
+    table = (np.arange(256) - mean) * factor + mean
+    return table.clip(0, 255).astype(np.uint8)
+
+
+def autocontrast_table(hist):
+    '''
+        hist: (256, ) histogram of one channel, cutoff=0 as autocontrast_func
+    '''
+    present = np.flatnonzero(hist)
+    low, high = present[0], present[-1]
+    if high <= low: return np.arange(256, dtype=np.uint8)
+    scale = 255. / (high - low)
+    offset = -low * scale
+    table = (np.arange(256) * scale + offset).clip(0, 255)
+    return table.astype(np.uint8)
+
+
+def equalize_table(hist):
+    '''
+        hist: (256, ) histogram of one channel, same as equalize_func
+    '''
+    non_zero_hist = hist[hist != 0]
+    step = np.sum(non_zero_hist[:-1]) // 255
+    if step == 0: return np.arange(256, dtype=np.uint8)
+    n = np.empty_like(hist)
+    n[0] = step // 2
+    n[1:] = hist[:-1]
+    return (np.cumsum(n) // step).clip(0, 255).astype(np.uint8)
+
+
+class LUTChain(object):
+    '''
+        fold a sequence of per-pixel intensity ops into one (256, C) table,
+        and apply it to the image with a single cv2.LUT.
+        Ops that depend on image statistics (contrast, autocontrast,
+        equalize) compute them from the histogram of the input image mapped
+        through the table folded so far, which is the same as computing
+        them from the intermediate image.
+    '''
+
+    def __init__(self, img):
+        self.img = img
+        self.n_chan = img.shape[2]
+        self.table = np.tile(np.arange(256, dtype=np.uint8)[:, None], (1, self.n_chan))
+        self.org_hist = None
+
+    def get_hist(self):
+        '''
+            (C, 256) histogram of the image after the ops folded so far
+        '''
+        if self.org_hist is None:
+            self.org_hist = np.stack([
+                cv2.calcHist([self.img], [c], None, [256], [0, 256]).ravel()
+                for c in range(self.n_chan)])
+        return np.stack([
+            np.bincount(self.table[:, c], weights=self.org_hist[c], minlength=256)
+            for c in range(self.n_chan)])
+
+    def append(self, name, *args):
+        if name == 'Invert':
+            table = invert_table()
+        elif name == 'Posterize':
+            table = posterize_table(*args)
+        elif name == 'Solarize':
+            table = solarize_table(*args)
+        elif name == 'SolarizeAdd':
+            table = solarized_add_table(*args)
+        elif name == 'Brightness':
+            table = brightness_table(quantize(args[0]))
+        elif name == 'Contrast':
+            hist = self.get_hist()
+            ch_mean = (hist * np.arange(256)).sum(axis=1) / hist.sum(axis=1)
+            mean = np.sum(ch_mean * np.array([0.114, 0.587, 0.299][:self.n_chan]))
+            table = contrast_table(mean, quantize(args[0]))
+        elif name == 'AutoContrast':
+            table = np.stack([autocontrast_table(el) for el in self.get_hist()], axis=1)
+        elif name == 'Equalize':
+            table = np.stack([equalize_table(el) for el in self.get_hist()], axis=1)
+        else:
+            raise NotImplementedError
+        if table.ndim == 1:
+            self.table = table[self.table]
+        else:
+            self.table = np.take_along_axis(table, self.table.astype(np.int64), axis=0)
+        return self
+
+    def apply(self):
+        if self.n_chan == 1:
+            return cv2.LUT(self.img, self.table[:, 0])[:, :, np.newaxis]
+        table = np.ascontiguousarray(self.table).reshape(256, 1, self.n_chan)
+        return cv2.LUT(self.img, table)
+
+
+lut_op_names = ('AutoContrast', 'Equalize', 'Invert', 'Posterize', 'Solarize',
+        'Contrast', 'Brightness', 'SolarizeAdd')
+
+
 ### args functions
 def enhance_level_to_args(MAX_LEVEL):
     def level_to_args(level):
@@ -359,11 +492,18 @@ class RandomOp(object):
         self.op_func = func_dict[name]
 
     def __call__(self, img, mag):
-        if np.random.rand() > self.prob or self.prob < 0: return img
-        args = self.arg_func(mag)
+        args = self.sample_args(mag)
+        if args is None: return img
         img = self.op_func(img, *args)
         return img
 
+    def sample_args(self, mag):
+        '''
+            None if the op is not employed this time
+        '''
+        if np.random.rand() > self.prob or self.prob < 0: return None
+        return self.arg_func(mag)
+
 
 OP_NAMES = [
     'AutoContrast', 'Equalize', 'Invert', 'Rotate', 'Posterize', 'Solarize',
@@ -376,21 +516,31 @@ class RandomAugment(object):
     ## TODO: 1. each op should have prob = 0.5 to decide whether employed
     ## 2. mag should be gaussian sampled at some std
 
-    def __init__(self, N, M):
+    def __init__(self, N, M, fuse_lut=True):
         self.N = N
         self.M = M
+        self.fuse_lut = fuse_lut
         self.ops = [RandomOp(name, prob=0.5) for name in OP_NAMES]
 
     def __call__(self, img):
         ops = np.random.choice(self.ops, self.N)
+        chain = None
         for op in ops:
             M = random.gauss(self.M, 0.5)
             M = min(max(0, M), MAX_LEVEL)
-            img = op(img, M)
+            args = op.sample_args(M)
+            if args is None: continue
+            ## consecutive intensity ops are folded into one lut
+            if self.fuse_lut and op.name in lut_op_names:
+                if chain is None: chain = LUTChain(img)
+                chain.append(op.name, *args)
+                continue
+            if chain is not None: img, chain = chain.apply(), None
+            img = op.op_func(img, *args)
+        if chain is not None: img = chain.apply()
         return img
 
 
-
 #  class ParseAugArgs(object):
 #
 #      def __init__(self, translate_const, cutout_const, MAX_LEVEL=10, replace_value=(128, 128, 128)):
@@ -622,3 +772,36 @@ if __name__ == '__main__':
     imcv = cv2.imread(pth)
     out_cv = cutout_func(imcv, 16, (128, 128, 128))
     cv2.imwrite('out_cv2.jpg', out_cv)
+
+    ##
+    img = np.random.randint(0, 256, (40, 32, 3), dtype=np.uint8)
+    img = cv2.resize(img, (256, 320), interpolation=cv2.INTER_CUBIC)
+    chains = [
+        [('Contrast', 1.3), ('Brightness', 0.8)],
+        [('Solarize', 128), ('AutoContrast', ), ('Posterize', 3)],
+        [('Invert', ), ('Equalize', ), ('SolarizeAdd', 60, 128), ('Contrast', 0.6)],
+    ]
+    for chain in chains:
+        out_seq = img
+        for name, *args in chain:
+            out_seq = func_dict[name](out_seq, *args)
+        lut = LUTChain(img)
+        for name, *args in chain: lut.append(name, *args)
+        out_lut = lut.apply()
+        diff = np.abs(out_seq.astype(np.float32) - out_lut.astype(np.float32))
+        print('lut chain', [el[0] for el in chain])
+        print(np.max(diff), np.mean(diff > 0))
+        # magnitudes here are multiples of the 1e-3 quantization step, the
+        # only difference left is float rounding of the contrast mean
+        assert np.max(diff) <= 1, chain
+    n_test = 1000
+    t1 = time.time()
+    for i in range(n_test):
+        out = brightness_func(contrast_func(img, 1.3), 0.8)
+    t2 = time.time()
+    for i in range(n_test):
+        out = LUTChain(img).append('Contrast', 1.3).append('Brightness', 0.8).apply()
+    t3 = time.time()
+    print('contrast + brightness')
+    print('sequential time: {}'.format(t2 - t1))
+    print('lut chain time: {}'.format(t3 - t2))
@@ -28,11 +28,13 @@ class RMSpropTF(Optimizer):
         decoupled_decay (bool, optional): decoupled weight decay as per https://arxiv.org/abs/1711.05101
         lr_in_momentum (bool, optional): learning rate scaling is included in the momentum buffer
             update as per defaults in Tensorflow
+        foreach (bool, optional): update parameters of the same device and dtype together with
+            multi-tensor (torch._foreach_*) ops instead of one by one (default: True)
 
     """
 
     def __init__(self, params, lr=1e-2, alpha=0.9, eps=1e-10, weight_decay=0, momentum=0., centered=False,
-                 decoupled_decay=False, lr_in_momentum=True):
+                 decoupled_decay=False, lr_in_momentum=True, foreach=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -45,7 +47,7 @@ class RMSpropTF(Optimizer):
             raise ValueError("Invalid alpha value: {}".format(alpha))
 
         defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, centered=centered, weight_decay=weight_decay,
-                        decoupled_decay=decoupled_decay, lr_in_momentum=lr_in_momentum)
+                        decoupled_decay=decoupled_decay, lr_in_momentum=lr_in_momentum, foreach=foreach)
         super(RMSpropTF, self).__init__(params, defaults)
 
     def __setstate__(self, state):
@@ -53,6 +55,8 @@ class RMSpropTF(Optimizer):
         for group in self.param_groups:
             group.setdefault('momentum', 0)
             group.setdefault('centered', False)
+            # pickled before foreach was a group option, it was an attribute
+            group.setdefault('foreach', state.get('foreach', False))
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -66,57 +70,159 @@ class RMSpropTF(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError('RMSprop does not support sparse gradients')
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['square_avg'] = torch.ones_like(p.data)  # PyTorch inits to zero
-                    if group['momentum'] > 0:
-                        state['momentum_buffer'] = torch.zeros_like(p.data)
-                    if group['centered']:
-                        state['grad_avg'] = torch.zeros_like(p.data)
-
-                square_avg = state['square_avg']
-                one_minus_alpha = 1. - group['alpha']
-
-                state['step'] += 1
-
-                if group['weight_decay'] != 0:
-                    if 'decoupled_decay' in group and group['decoupled_decay']:
-                        p.data.add_(p.data, alpha=-group['weight_decay'])
-                    else:
-                        grad = grad.add(p.data, alpha=group['weight_decay'])
-
-                # Tensorflow order of ops for updating squared avg
-                square_avg.add_(grad.pow(2) - square_avg, alpha=one_minus_alpha)
-                # square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)  # PyTorch original
-
-                if group['centered']:
-                    grad_avg = state['grad_avg']
-                    grad_avg.add_(grad - grad_avg, alpha=one_minus_alpha)
-                    # grad_avg.mul_(alpha).add_(1 - alpha, grad)  # PyTorch original
-                    avg = square_avg.addcmul(-1, grad_avg, grad_avg).add(group['eps']).sqrt_()  # eps moved in sqrt
-                else:
-                    avg = square_avg.add(group['eps']).sqrt_()  # eps moved in sqrt
-
-                if group['momentum'] > 0:
-                    buf = state['momentum_buffer']
-                    # Tensorflow accumulates the LR scaling in the momentum buffer
-                    if 'lr_in_momentum' in group and group['lr_in_momentum']:
-                        buf.mul_(group['momentum']).addcdiv_(grad, avg, value=group['lr'])
-                        p.data.add_(-buf)
-                    else:
-                        # PyTorch scales the param update by LR
-                        buf.mul_(group['momentum']).addcdiv_(grad, avg)
-                        p.data.add_(buf, alpha=-group['lr'])
-                else:
-                    p.data.addcdiv_(grad, avg, value=-group['lr'])
+            if group['foreach']:
+                self.step_foreach(group)
+            else:
+                self.step_loop(group)
 
         return loss
+
+    def init_state(self, p, group):
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            state['square_avg'] = torch.ones_like(p.data)  # PyTorch inits to zero
+            if group['momentum'] > 0:
+                state['momentum_buffer'] = torch.zeros_like(p.data)
+            if group['centered']:
+                state['grad_avg'] = torch.zeros_like(p.data)
+        return state
+
+    @torch.no_grad()
+    def step_foreach(self, group):
+        # same math as step_loop, tensors of one device and dtype go through each op together
+        tensor_groups = {}
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('RMSprop does not support sparse gradients')
+            state = self.init_state(p, group)
+            state['step'] += 1
+            tensor_groups.setdefault((p.device, p.dtype), []).append((p, state))
+
+        one_minus_alpha = 1. - group['alpha']
+        for pairs in tensor_groups.values():
+            params = [p for p, _ in pairs]
+            grads = [p.grad for p in params]
+            square_avgs = [state['square_avg'] for _, state in pairs]
+
+            if group['weight_decay'] != 0:
+                if 'decoupled_decay' in group and group['decoupled_decay']:
+                    torch._foreach_add_(params, params, alpha=-group['weight_decay'])
+                else:
+                    grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+
+            # Tensorflow order of ops for updating squared avg
+            diffs = torch._foreach_mul(grads, grads)
+            torch._foreach_sub_(diffs, square_avgs)
+            torch._foreach_add_(square_avgs, diffs, alpha=one_minus_alpha)
+
+            if group['centered']:
+                grad_avgs = [state['grad_avg'] for _, state in pairs]
+                diffs = torch._foreach_sub(grads, grad_avgs)
+                torch._foreach_add_(grad_avgs, diffs, alpha=one_minus_alpha)
+                avgs = torch._foreach_addcmul(square_avgs, grad_avgs, grad_avgs, value=-1)
+                torch._foreach_add_(avgs, group['eps'])
+            else:
+                avgs = torch._foreach_add(square_avgs, group['eps'])
+            torch._foreach_sqrt_(avgs)  # eps moved in sqrt
+
+            if group['momentum'] > 0:
+                bufs = [state['momentum_buffer'] for _, state in pairs]
+                torch._foreach_mul_(bufs, group['momentum'])
+                # Tensorflow accumulates the LR scaling in the momentum buffer
+                if 'lr_in_momentum' in group and group['lr_in_momentum']:
+                    torch._foreach_addcdiv_(bufs, grads, avgs, value=group['lr'])
+                    torch._foreach_sub_(params, bufs)
+                else:
+                    # PyTorch scales the param update by LR
+                    torch._foreach_addcdiv_(bufs, grads, avgs)
+                    torch._foreach_add_(params, bufs, alpha=-group['lr'])
+            else:
+                torch._foreach_addcdiv_(params, grads, avgs, value=-group['lr'])
+
+    def step_loop(self, group):
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            grad = p.grad.data
+            if grad.is_sparse:
+                raise RuntimeError('RMSprop does not support sparse gradients')
+            state = self.init_state(p, group)
+
+            square_avg = state['square_avg']
+            one_minus_alpha = 1. - group['alpha']
+
+            state['step'] += 1
+
+            if group['weight_decay'] != 0:
+                if 'decoupled_decay' in group and group['decoupled_decay']:
+                    p.data.add_(p.data, alpha=-group['weight_decay'])
+                else:
+                    grad = grad.add(p.data, alpha=group['weight_decay'])
+
+            # Tensorflow order of ops for updating squared avg
+            square_avg.add_(grad.pow(2) - square_avg, alpha=one_minus_alpha)
+            # square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)  # PyTorch original
+
+            if group['centered']:
+                grad_avg = state['grad_avg']
+                grad_avg.add_(grad - grad_avg, alpha=one_minus_alpha)
+                # grad_avg.mul_(alpha).add_(1 - alpha, grad)  # PyTorch original
+                avg = square_avg.addcmul(grad_avg, grad_avg, value=-1).add(group['eps']).sqrt_()  # eps moved in sqrt
+            else:
+                avg = square_avg.add(group['eps']).sqrt_()  # eps moved in sqrt
+
+            if group['momentum'] > 0:
+                buf = state['momentum_buffer']
+                # Tensorflow accumulates the LR scaling in the momentum buffer
+                if 'lr_in_momentum' in group and group['lr_in_momentum']:
+                    buf.mul_(group['momentum']).addcdiv_(grad, avg, value=group['lr'])
+                    p.data.add_(-buf)
+                else:
+                    # PyTorch scales the param update by LR
+                    buf.mul_(group['momentum']).addcdiv_(grad, avg)
+                    p.data.add_(buf, alpha=-group['lr'])
+            else:
+                p.data.addcdiv_(grad, avg, value=-group['lr'])
+
+
+if __name__ == '__main__':
+    import time
+    import copy
+    from cbl_models import EfficientNet
+
+    ## parity with the per-parameter loop, on every combination of options
+    torch.manual_seed(0)
+    model = EfficientNet('b0_sepconv', n_classes=10)
+    inten = torch.randn(2, 3, 64, 64)
+    for opts in (dict(momentum=0.9), dict(momentum=0.9, lr_in_momentum=False),
+            dict(weight_decay=1e-4, decoupled_decay=True), dict(weight_decay=1e-4),
+            dict(momentum=0.9, centered=True)):
+        models = [copy.deepcopy(model) for _ in range(2)]
+        optims = [RMSpropTF(el.parameters(), lr=1e-3, foreach=foreach, **opts)
+                for el, foreach in zip(models, (False, True))]
+        for _ in range(3):
+            for el, optim in zip(models, optims):
+                optim.zero_grad()
+                el(inten).sum().backward()
+                optim.step()
+        diff = max((p1 - p2).abs().max().item() for p1, p2 in
+                zip(models[0].parameters(), models[1].parameters()))
+        print(f'{opts}: max param diff {diff:.2e}')
+        assert diff < 1e-5
+
+    ## step time
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = EfficientNet('b0_sepconv', n_classes=1000).to(device)
+    for p in model.parameters(): p.grad = torch.randn_like(p)
+    for foreach in (False, True):
+        optim = RMSpropTF(model.parameters(), lr=1e-5, momentum=0.9,
+                weight_decay=1e-5, foreach=foreach)
+        for _ in range(3): optim.step()
+        if device == 'cuda': torch.cuda.synchronize()
+        t1 = time.time()
+        for _ in range(50): optim.step()
+        if device == 'cuda': torch.cuda.synchronize()
+        print(f'foreach={foreach}: {(time.time() - t1) / 50 * 1e3:.3f} ms/step')
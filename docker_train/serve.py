@@ -0,0 +1,274 @@
+import os
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import cv2
+import numpy as np
+
+import torch
+
+from export import load_model
+from transforms import ResizeCenterCrop, ToTensor, Normalize
+
+
+'''
+    cpu inference service for trained classifiers:
+
+        python serve.py --model r50=config/resnet50.py:./res/model_final_ema.pth \
+            --port 8000 --n-workers 2 --num-threads 8
+
+    POST /predict/{name} with an encoded image (or an .npy array of an already
+    preprocessed (in_chan, crop_size, crop_size) image with Content-Type:
+    application/x-npy) returns the top-k classes, softmax scores or sigmoid
+    score of models with a single logit. GET /stats returns latency percentiles and throughput.
+    Requests of one model are grouped into micro batches of at most
+    --max-batch images, a batch is run once it is full or when its oldest
+    request has waited --max-latency-ms.
+'''
+
+
+torch.set_grad_enabled(False)
+
+
+def parse_args():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--model', dest='models', type=str, nargs='+', required=True,
+            help='name=config_file:ckpt_path, can be given several times')
+    parse.add_argument('--host', dest='host', type=str, default='127.0.0.1',)
+    parse.add_argument('--port', dest='port', type=int, default=8000,)
+    parse.add_argument('--unix-socket', dest='unix_socket', type=str, default=None,)
+    parse.add_argument('--max-batch', dest='max_batch', type=int, default=32,)
+    parse.add_argument('--max-latency-ms', dest='max_latency_ms', type=float, default=10.,)
+    parse.add_argument('--n-workers', dest='n_workers', type=int, default=2,)
+    parse.add_argument('--num-threads', dest='num_threads', type=int, default=None,
+            help='size of the intra-op thread pool of torch, shared by all '
+            'workers of all models, defaults to the torch default')
+    parse.add_argument('--topk', dest='topk', type=int, default=5,)
+    return parse.parse_args()
+
+
+class LatencyMeter(object):
+    '''
+        latency of the last `window` requests and total counts, thread safe
+    '''
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.stamps = deque(maxlen=window)
+        self.n_requests, self.n_batches = 0, 0
+        self.t_start = time.time()
+
+    def update(self, latencies, now):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.stamps.extend([now, ] * len(latencies))
+            self.n_requests += len(latencies)
+            self.n_batches += 1
+
+    def get(self):
+        with self.lock:
+            lats = np.array(self.latencies, dtype=np.float64)
+            stamps = list(self.stamps)
+            n_requests, n_batches = self.n_requests, self.n_batches
+        stats = dict(n_requests=n_requests, n_batches=n_batches,
+                avg_batch=n_requests / max(n_batches, 1),
+                throughput_total=n_requests / (time.time() - self.t_start))
+        if len(lats) > 0:
+            p50, p99 = np.percentile(lats, [50, 99])
+            stats.update(p50_ms=p50 * 1e3, p99_ms=p99 * 1e3)
+        if len(stamps) > 1 and stamps[-1] > stamps[0]:
+            stats['throughput_window'] = (len(stamps) - 1) / (stamps[-1] - stamps[0])
+        return stats
+
+
+class MicroBatcher(object):
+    '''
+        requests are queued with their arrival time, each worker thread takes
+        the oldest request and keeps collecting until the batch is full or the
+        deadline of the oldest request is reached, then runs the batch
+    '''
+
+    def __init__(self, model, max_batch=32, max_latency_ms=10., n_workers=1):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms * 1e-3
+        self.queue = queue.Queue()
+        self.meter = LatencyMeter()
+        self.workers = [threading.Thread(target=self.run, daemon=True)
+                for _ in range(n_workers)]
+        for worker in self.workers: worker.start()
+
+    def submit(self, im):
+        fut = Future()
+        self.queue.put((im, fut, time.time()))
+        return fut
+
+    def collect(self):
+        batch = [self.queue.get(), ]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0: break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        # grad mode is thread local
+        torch.set_grad_enabled(False)
+        while True:
+            batch = self.collect()
+            ims, futs, t_arrive = zip(*batch)
+            try:
+                logits = self.model(torch.stack(ims, dim=0))
+                # single logit models are trained with bce
+                if logits.size(1) == 1:
+                    probs = logits.sigmoid()
+                else:
+                    probs = logits.softmax(dim=1)
+            except Exception as e:
+                for fut in futs: fut.set_exception(e)
+                continue
+            now = time.time()
+            for fut, prob in zip(futs, probs): fut.set_result(prob)
+            self.meter.update([now - t for t in t_arrive], now)
+
+
+class Classifier(object):
+
+    def __init__(self, cfg_file, ckpt_path, batcher_args):
+        cfg, self.model = load_model(cfg_file, ckpt_path)
+        ## override in config with serve_args, defaults to imagenet val
+        serve_args = getattr(cfg, 'serve_args', {})
+        crop_size = serve_args.get('crop_size', getattr(cfg, 'cropsize', 224))
+        short_size = serve_args.get('short_size', int(crop_size * 256 / 224))
+        mean = serve_args.get('mean', (0.485, 0.456, 0.406))
+        std = serve_args.get('std', (0.229, 0.224, 0.225))
+        self.in_chan = serve_args.get('in_chan', 3)
+        self.crop_size = crop_size
+        self.resize_crop = ResizeCenterCrop(crop_size, short_size)
+        self.to_tensor = ToTensor()
+        self.normalize = Normalize(mean, std)
+        self.batcher = MicroBatcher(self.model, **batcher_args)
+
+    def preprocess(self, data, content_type):
+        if content_type == 'application/x-npy':
+            im = np.load(io.BytesIO(data), allow_pickle=False)
+            shape = (self.in_chan, self.crop_size, self.crop_size)
+            # a bad array would fail the whole micro batch it is stacked into
+            if im.shape != shape:
+                raise ValueError(f'array of shape {im.shape}, expect {shape}')
+            return torch.from_numpy(im.astype(np.float32))
+        im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if im is None: raise ValueError('cannot decode image')
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        im = self.resize_crop(im)
+        im = self.normalize(self.to_tensor(im))
+        return torch.from_numpy(np.ascontiguousarray(im))
+
+    def predict(self, data, content_type, topk=5):
+        prob = self.batcher.submit(self.preprocess(data, content_type)).result()
+        scores, inds = prob.topk(min(topk, prob.numel()))
+        return dict(labels=inds.tolist(), scores=scores.tolist())
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    ## set by serve()
+    classifiers = {}
+    topk = 5
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = {name: clf.batcher.meter.get()
+                    for name, clf in self.classifiers.items()}
+            self.send_json(200, stats)
+        elif self.path == '/models':
+            self.send_json(200, list(self.classifiers.keys()))
+        else:
+            self.send_json(404, dict(error=f'unknown path {self.path}'))
+
+    def do_POST(self):
+        prefix = '/predict/'
+        name = self.path[len(prefix):] if self.path.startswith(prefix) else None
+        if not name in self.classifiers:
+            self.send_json(404, dict(error=f'unknown model in {self.path}'))
+            return
+        n_bytes = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(n_bytes)
+        content_type = self.headers.get('Content-Type', '')
+        try:
+            res = self.classifiers[name].predict(data, content_type, self.topk)
+        except ValueError as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+        except Exception as e:
+            self.send_json(500, dict(error=str(e)))
+            return
+        self.send_json(200, res)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # client address of unix sockets is an empty string, which the http
+        # handler cannot log
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        return request, ('unix', 0)
+
+
+def serve(args):
+    ## torch.set_num_threads is process global, every model has its own
+    ## n_workers threads and they all run their ops in this one pool
+    if not args.num_threads is None: torch.set_num_threads(args.num_threads)
+    batcher_args = dict(max_batch=args.max_batch,
+            max_latency_ms=args.max_latency_ms, n_workers=args.n_workers)
+    classifiers = {}
+    for spec in args.models:
+        name, paths = spec.split('=', 1)
+        cfg_file, ckpt_path = paths.split(':', 1)
+        classifiers[name] = Classifier(cfg_file, ckpt_path, batcher_args)
+        print(f'loaded {name}: {cfg_file}, {ckpt_path}')
+    RequestHandler.classifiers = classifiers
+    RequestHandler.topk = args.topk
+
+    if args.unix_socket is None:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print(f'serving on http://{args.host}:{args.port}')
+    else:
+        if os.path.exists(args.unix_socket): os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, RequestHandler)
+        print(f'serving on unix socket {args.unix_socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(parse_args())
@@ -0,0 +1,5 @@
+import os.path as osp
+import sys
+
+## modules of docker_train are imported by top level names, as in the scripts
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
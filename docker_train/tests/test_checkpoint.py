@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import numpy as np
+import torch.nn as nn
+
+from checkpoint import (AsyncCheckpointer, load_latest_checkpoint,
+        list_checkpoints, get_rng_states, set_rng_states)
+from lr_scheduler import WarmupCosineLrScheduler
+from meters import TimeMeter, DeviceAvgMeter
+from ops import EMA, MixUper
+from train_step import train_step
+
+
+N_EPOCHES, N_ITERS_PER_EPOCH = 4, 3
+
+
+def build_train_objs():
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        nn.Conv2d(3, 8, 3, 1, 1), nn.BatchNorm2d(8), nn.ReLU(),
+        nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, 10))
+    optim = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9,
+            weight_decay=1e-4)
+    scheduler = WarmupCosineLrScheduler(optim, max_iter=N_EPOCHES,
+            warmup_iter=1, warmup_ratio=0.1, warmup='linear')
+    scheduler.update_by_iter(N_ITERS_PER_EPOCH)
+    return dict(model=model, ema=EMA(model, 0.9), optim=optim,
+            scaler=torch.amp.GradScaler('cpu', enabled=False),
+            scheduler=scheduler, time_meter=TimeMeter(N_EPOCHES * N_ITERS_PER_EPOCH),
+            loss_meter=DeviceAvgMeter())
+
+
+def run(train_objs, start_epoch, end_epoch, checkpointer=None):
+    ## data and mixup draw from the global rng streams, as the dataloader
+    ## and augmentations of train.py do
+    model, optim, scaler = (train_objs[k] for k in ('model', 'optim', 'scaler'))
+    crit, mixuper = nn.CrossEntropyLoss(), MixUper(0.2)
+    for e in range(start_epoch, end_epoch):
+        np.random.seed(123 + e)
+        model.train()
+        for _ in range(N_ITERS_PER_EPOCH):
+            im = torch.randn(8, 3, 16, 16) + float(np.random.rand())
+            lb = nn.functional.one_hot(torch.randint(0, 10, (8, )), 10).float()
+            im, lb = mixuper(im, lb)
+            optim.zero_grad()
+            loss = train_step(model, crit, optim, scaler, im, lb, 2)
+            train_objs['ema'].update_params()
+            train_objs['time_meter'].update()
+            train_objs['loss_meter'].update(loss)
+            train_objs['scheduler'].step()
+        if not checkpointer is None:
+            state = {k: v.state_dict() for k, v in train_objs.items()}
+            state.update(dict(epoch=e + 1, rng=[get_rng_states(), ]))
+            checkpointer.save(state, e + 1)
+
+
+def flat_state(train_objs):
+    tensors = []
+    def collect(obj):
+        if isinstance(obj, torch.Tensor): tensors.append(obj)
+        elif isinstance(obj, dict):
+            for k in sorted(obj.keys(), key=str): collect(obj[k])
+        elif isinstance(obj, (list, tuple)):
+            for el in obj: collect(el)
+        else: tensors.append(obj)
+    for k in ('model', 'ema', 'optim', 'scheduler', 'loss_meter'):
+        collect(train_objs[k].state_dict())
+    return tensors
+
+
+def test_resume_matches_straight_run(tmp_path):
+    straight = build_train_objs()
+    run(straight, 0, N_EPOCHES)
+
+    ckpt_dir = str(tmp_path / 'ckpt')
+    checkpointer = AsyncCheckpointer(ckpt_dir, keep=1)
+    run(build_train_objs(), 0, 2, checkpointer)
+    checkpointer.close()
+    assert [os.path.basename(el) for el in list_checkpoints(ckpt_dir)] == ['ckpt_0002.pth']
+
+    ## fresh objects and other rng states, as in a new process
+    torch.manual_seed(1)
+    np.random.seed(1)
+    resumed = build_train_objs()
+    state = load_latest_checkpoint(ckpt_dir)
+    for k, v in resumed.items(): v.load_state_dict(state[k])
+    set_rng_states(state['rng'][0])
+    run(resumed, state['epoch'], N_EPOCHES)
+
+    states = flat_state(straight), flat_state(resumed)
+    assert len(states[0]) == len(states[1])
+    for v1, v2 in zip(*states):
+        if isinstance(v1, torch.Tensor):
+            assert torch.equal(v1, v2)
+        else:
+            assert v1 == v2
+
+
+def test_keep_at_least_one(tmp_path):
+    with pytest.raises(AssertionError):
+        AsyncCheckpointer(str(tmp_path), keep=0)
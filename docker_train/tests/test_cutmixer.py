@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from ops import CutMixer
+
+
+def cutmix_loop(beta_generator, ims, lbs):
+    ## per-sample patch copy of the previous CutMixer on cpu, same random
+    ## draws in the same order. Patches are read from the input batch, the
+    ## old in-place loop read patches that earlier iterations had pasted into
+    bs = ims.size(0)
+    lam = beta_generator.sample([bs, ])
+    indices = torch.randperm(bs).tolist()
+
+    H, W = ims.size(2), ims.size(3)
+    ratio = (1. - lam).sqrt()
+    h, w = (H * ratio).long(), (W * ratio).long()
+    ch, cw = torch.randint(0, H, (bs, )), torch.randint(0, W, (bs, ))
+    x1 = (ch - h.floor_divide(2)).clamp(0, H)
+    y1 = (cw - w.floor_divide(2)).clamp(0, W)
+    x2 = (ch + h.floor_divide(2)).clamp(0, H)
+    y2 = (cw + w.floor_divide(2)).clamp(0, W)
+    out = ims.clone()
+    for ii, (xx1, xx2, yy1, yy2) in enumerate(zip(x1, x2, y1, y2)):
+        out[ii, :, xx1:xx2, yy1:yy2] = ims[indices[ii], :, xx1:xx2, yy1:yy2]
+    lam = 1. - ((x2 - x1) * (y2 - y1)).float().div(float(H * W))
+
+    lam = lam.view(-1, 1)
+    lbs = lam * lbs + (1. - lam) * lbs[indices]
+    return out, lbs, lam.view(-1), indices
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_loop(seed):
+    torch.manual_seed(123)
+    ims, lbs = torch.randn(16, 3, 32, 48), torch.eye(16)
+    cutmixer = CutMixer(1.)
+    torch.manual_seed(seed)
+    ims_mix, lbs_mix = cutmixer(ims.clone(), lbs)
+    torch.manual_seed(seed)
+    ims_ref, lbs_ref, lam_ref, indices = cutmix_loop(cutmixer.beta_generator, ims, lbs)
+    assert torch.equal(ims_mix, ims_ref)
+    assert torch.allclose(lbs_mix, lbs_ref)
+    ## with one-hot labels, lambda is left on the diagonal
+    for ii, jj in enumerate(indices):
+        if ii != jj: assert torch.isclose(lbs_mix[ii, ii], lam_ref[ii])
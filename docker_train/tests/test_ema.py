@@ -0,0 +1,107 @@
+import copy
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import torch.nn as nn
+
+from ops.ema import EMA, stochastic_round_bf16
+
+
+def build_model():
+    model = nn.Sequential(nn.Conv2d(3, 16, 3, 1, 1), nn.BatchNorm2d(16),
+            nn.ReLU(), nn.Conv2d(16, 16, 3, 1, 1))
+    model(torch.randn(2, 3, 8, 8)) # non trivial running stats
+    return model
+
+
+@torch.no_grad()
+def perturb(model, scale=1e-2):
+    for p in model.parameters(): p.add_(torch.randn_like(p), alpha=scale)
+
+
+@torch.no_grad()
+def test_foreach_matches_reference():
+    torch.manual_seed(0)
+    model = build_model()
+    ema = EMA(model, 0.999)
+    ref = copy.deepcopy(model)
+    for step in range(1, 21):
+        perturb(model)
+        ema.update_params()
+        decay = min(0.999, step / (step + 9))
+        state = model.state_dict()
+        for name, val in ref.state_dict().items():
+            if val.is_floating_point():
+                val.mul_(decay).add_(state[name], alpha=1. - decay)
+            else:
+                val.copy_(state[name])
+    for k, v in ref.state_dict().items():
+        assert torch.allclose(ema.ema_model.state_dict()[k].float(), v.float(), atol=1e-6), k
+
+
+@torch.no_grad()
+def test_bf16_shadow_tracks_fp32():
+    ## weights drift slowly under noise, updates at decay 0.9999 are far
+    ## below a bf16 ulp of the shadow
+    torch.manual_seed(0)
+    model = nn.Linear(128, 128)
+    ema32 = EMA(model, 0.9999)
+    ema16 = EMA(model, 0.9999, dtype='bfloat16')
+    assert sum(ema16.memory_bytes().values()) < 0.6 * sum(ema32.memory_bytes().values())
+    direction = [torch.randn_like(p) for p in model.parameters()]
+    for _ in range(5000):
+        for p, d in zip(model.parameters(), direction):
+            p.add_(torch.randn_like(p), alpha=2e-3).add_(d, alpha=5e-5)
+        ema32.update_params()
+        ema16.update_params()
+    state32 = ema32.ema_model.state_dict()
+    state16 = ema16.materialize().state_dict()
+    for name, p in model.named_parameters():
+        err = (state16[name] - state32[name]).abs().mean()
+        gap = (state32[name] - p).abs().mean()
+        assert err < 0.3 * gap, name
+        assert err < 2e-2 * state32[name].abs().mean(), name
+
+
+@torch.no_grad()
+def test_stochastic_rounding_is_unbiased():
+    x = torch.full((1 << 16, ), 1. + 2. ** -12)
+    out = stochastic_round_bf16(x.clone()).float()
+    assert set(out.unique().tolist()) == {1., 1. + 2. ** -7}
+    assert abs(out.mean().item() - x[0].item()) < 1e-5
+    ## rounding to nearest loses the small part
+    assert x.to(torch.bfloat16).float().mean().item() == 1.
+
+
+@torch.no_grad()
+def test_state_dict_by_name():
+    torch.manual_seed(0)
+    model = build_model()
+    ema = EMA(model, 0.99, dtype='bfloat16')
+    for _ in range(3):
+        perturb(model)
+        ema.update_params()
+    state = ema.state_dict()
+    assert set(state['shadow'].keys()) == set(model.state_dict().keys())
+
+    ## a model with a module added in front loads the shadow by name
+    model2 = nn.Sequential(nn.Identity(), *build_model())
+    model2.load_state_dict({f'{int(k[0]) + 1}{k[1:]}': v
+        for k, v in model.state_dict().items()})
+    ema2 = EMA(model2, 0.99, dtype='bfloat16')
+    ema2.load_state_dict({**state, 'shadow': {f'{int(k[0]) + 1}{k[1:]}': v
+        for k, v in state['shadow'].items()}})
+    assert ema2.step == ema.step
+    for k, v in ema.materialize().state_dict().items():
+        k2 = f'{int(k[0]) + 1}{k[1:]}'
+        assert torch.equal(ema2.materialize().state_dict()[k2], v), k
+
+    ## same generator state, so the next updates are identical
+    perturb(model)
+    model2.load_state_dict({f'{int(k[0]) + 1}{k[1:]}': v
+        for k, v in model.state_dict().items()})
+    ema.update_params()
+    ema2.update_params()
+    for name, dst in zip(ema.avg_names, ema.avg_dst):
+        assert torch.equal(dst, ema2.state_dict()['shadow'][f'{int(name[0]) + 1}{name[1:]}'])
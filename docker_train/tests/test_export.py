@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('pytorch_loss')
+
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from cbl_models import build_model
+from export import load_model, export_torchscript
+
+
+def randomize_bn(model):
+    for mod in model.modules():
+        if isinstance(mod, _BatchNorm):
+            mod.running_mean.uniform_(-0.1, 0.1)
+            mod.running_var.uniform_(0.5, 1.5)
+
+
+## models that used to only have get_states
+@pytest.mark.parametrize('model_args', [
+    dict(model_type='BiSeNetV2TrainWrapper', n_classes=10),
+    dict(model_type='PAResNet', n_layers=50, n_classes=10),
+    dict(model_type='Xception41', n_classes=10),
+])
+@torch.no_grad()
+def test_load_model_parity(tmp_path, model_args):
+    torch.manual_seed(0)
+    model = build_model(model_args)
+    randomize_bn(model)
+    model.eval()
+    ckpt_pth = tmp_path / 'model.pth'
+    torch.save(model.get_states(), ckpt_pth)
+    cfg_pth = tmp_path / 'cfg.py'
+    cfg_pth.write_text(f'model_args = {model_args!r}\ncropsize = 64\n')
+
+    _, model_export = load_model(str(cfg_pth), str(ckpt_pth))
+    inten = torch.randn(2, 3, 64, 64)
+    out = model(inten)
+    out = out[0] if isinstance(out, (tuple, list)) else out
+    tol = 1e-3 * max(1., out.abs().max().item())
+    assert (model_export(inten) - out).abs().max().item() <= tol
+
+    ## the exported graph against the unfused model of the checkpoint
+    _, model_ref = load_model(str(cfg_pth), str(ckpt_pth), fuse=False)
+    script = export_torchscript(model_export, inten, str(tmp_path / 'model.ts'))
+    inten = torch.randn(3, 3, 64, 64)
+    assert (script(inten) - model_ref(inten)).abs().max().item() <= tol
@@ -0,0 +1,91 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('pytorch_loss')
+
+import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from cbl_models import ResNet, PAResNet, RepVGG, BiSeNetV2TrainWrapper, fuse_model
+from cbl_models.conv_ops import Conv2dWS
+
+
+def randomize_bn(model):
+    for mod in model.modules():
+        if isinstance(mod, _BatchNorm):
+            mod.running_mean.uniform_(-0.1, 0.1)
+            mod.running_var.uniform_(0.5, 1.5)
+            mod.weight.data.uniform_(0.5, 1.5)
+            mod.bias.data.uniform_(-0.1, 0.1)
+
+
+def count_bn(model):
+    return sum(isinstance(mod, _BatchNorm) for mod in model.modules())
+
+
+def first_output(out):
+    return out[0] if isinstance(out, (tuple, list)) else out
+
+
+class ConvBNPairs(nn.Module):
+    ## conv -> bn, Conv2dWS -> bn, bn -> 1x1 conv without padding
+    def __init__(self):
+        super(ConvBNPairs, self).__init__()
+        self.conv1 = nn.Conv2d(3, 8, 3, 1, 1, bias=False)
+        self.bn1 = nn.BatchNorm2d(8)
+        self.conv2 = Conv2dWS(8, 8, 3, 1, 1, bias=True)
+        self.bn2 = nn.BatchNorm2d(8)
+        self.bn3 = nn.BatchNorm2d(8)
+        self.conv3 = nn.Conv2d(8, 4, 1, 1, 0, bias=True)
+
+    def forward(self, x):
+        x = self.bn1(self.conv1(x)).relu()
+        x = self.bn2(self.conv2(x)).relu()
+        return self.conv3(self.bn3(x))
+
+
+@torch.no_grad()
+def test_fuse_pairs():
+    torch.manual_seed(0)
+    model = ConvBNPairs()
+    randomize_bn(model)
+    model.eval()
+    inten = torch.randn(2, 3, 16, 16)
+    out = model(inten)
+    fuse_model(model)
+    assert count_bn(model) == 0
+    assert torch.allclose(model(inten), out, atol=1e-4)
+
+
+@torch.no_grad()
+def test_bn_before_padded_conv_is_kept():
+    ## zero padding sees bn output, so bn cannot go into the conv
+    model = nn.Sequential(nn.BatchNorm2d(3), nn.Conv2d(3, 4, 3, 1, 1))
+    randomize_bn(model)
+    model.eval()
+    inten = torch.randn(2, 3, 8, 8)
+    out = model(inten)
+    fuse_model(model)
+    assert count_bn(model) == 1
+    assert torch.allclose(model(inten), out, atol=1e-5)
+
+
+@pytest.mark.parametrize('build', [
+    lambda: ResNet(n_layers=50, n_classes=10),
+    lambda: PAResNet(n_layers=50, n_classes=10),
+    lambda: RepVGG(mtype='a0', n_classes=10),
+    lambda: BiSeNetV2TrainWrapper(n_classes=10),
+])
+@torch.no_grad()
+def test_fuse_model_families(build):
+    torch.manual_seed(0)
+    model = build()
+    randomize_bn(model)
+    model.eval()
+    inten = torch.randn(2, 3, 64, 64)
+    out = first_output(model(inten))
+    n_bn = count_bn(model)
+    fuse_model(model)
+    assert count_bn(model) < n_bn
+    diff = (first_output(model(inten)) - out).abs().max().item()
+    assert diff <= 1e-3 * max(1., out.abs().max().item())
@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from metrics import RocAucMeter
+
+
+def exact_roc_auc(scores, gts):
+    pos, neg = scores[gts == 1], scores[gts == 0]
+    greater = (pos[:, None] > neg[None, :]).double().sum()
+    ties = (pos[:, None] == neg[None, :]).double().sum()
+    return ((greater + 0.5 * ties) / (pos.numel() * neg.numel())).item()
+
+
+@pytest.mark.parametrize('n_samples', [1000, 3000])
+def test_roc_auc_within_bound(n_samples):
+    torch.manual_seed(n_samples)
+    gts = (torch.rand(n_samples) < 0.1).long()
+    scores = (torch.randn(n_samples) + gts.float() * 1.5).sigmoid()
+    ## plenty of duplicated scores
+    scores[:n_samples // 4] = scores[:n_samples // 4].mul(100).round().div(100)
+    exact = exact_roc_auc(scores, gts)
+    bounds = []
+    for mantissa_bits in (4, 10, 16):
+        meter = RocAucMeter(mantissa_bits=mantissa_bits)
+        for sc, gt in zip(scores.split(256), gts.split(256)):
+            meter.update(sc.view(-1, 1), gt.view(-1, 1))
+        roc_auc, bound = meter.compute()
+        assert abs(roc_auc - exact) <= bound + 1e-9
+        assert meter.hist.numel() == 2 * meter.n_bins
+        bounds.append(bound)
+    ## finer bins only leave the real ties
+    assert bounds[0] >= bounds[1] >= bounds[2]
+    assert bounds[2] < 1e-2
+
+
+def test_mantissa_bits_is_bounded():
+    with pytest.raises(AssertionError):
+        RocAucMeter(mantissa_bits=23)
@@ -0,0 +1,43 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from ops import MixUper
+
+
+def mixup_ref(beta_generator, ims, lbs, use_batch):
+    ## out of place MixUper before the in-place version, on cpu
+    bs = ims.size(0)
+    if use_batch:
+        lam = beta_generator.sample([bs, 1, 1, 1])
+        lam = torch.where(lam > (1. - lam), lam, (1. - lam))
+        indices = torch.randperm(bs)
+        ims = lam * ims + (1. - lam) * ims[indices]
+        lam = lam.view(-1, 1)
+        lbs = lam * lbs + (1. - lam) * lbs[indices]
+    else:
+        lam = beta_generator.sample()
+        indices = torch.randperm(bs)
+        ims = lam * ims + (1. - lam) * ims[indices]
+        lbs = lam * lbs + (1. - lam) * lbs[indices]
+    return ims, lbs, lam.view(-1).expand(bs), indices.tolist()
+
+
+@pytest.mark.parametrize('use_batch', [True, False])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_out_of_place(use_batch, seed):
+    torch.manual_seed(123)
+    ims, lbs = torch.randn(16, 3, 32, 32), torch.eye(16)
+    mixuper = MixUper(0.4, use_batch=use_batch)
+    torch.manual_seed(seed)
+    ims_in = ims.clone()
+    ims_mix, lbs_mix = mixuper(ims_in, lbs)
+    torch.manual_seed(seed)
+    ims_ref, lbs_ref, lam_ref, indices = mixup_ref(mixuper.beta_generator,
+            ims, lbs, use_batch)
+    assert ims_mix.data_ptr() == ims_in.data_ptr() # mixed in place
+    assert torch.allclose(ims_mix, ims_ref, atol=1e-6)
+    assert torch.allclose(lbs_mix, lbs_ref, atol=1e-6)
+    ## with one-hot labels, lambda is left on the diagonal
+    for ii, jj in enumerate(indices):
+        if ii != jj: assert torch.isclose(lbs_mix[ii, ii], lam_ref[ii], atol=1e-6)
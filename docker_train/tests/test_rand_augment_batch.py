@@ -0,0 +1,76 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+torch = pytest.importorskip('torch')
+
+import rand_augment_cv2 as RA
+from rand_augment_cv2 import OP_NAMES
+from rand_augment_batch import (BatchRandomAugment, apply_ops, arg_dict,
+        func_dict, replace_value)
+
+
+@pytest.fixture(scope='module')
+def images():
+    rng = np.random.RandomState(0)
+    ims = []
+    for _ in range(4):
+        im = rng.randint(0, 256, (28, 25, 3)).astype(np.uint8)
+        ims.append(cv2.resize(im, (200, 224), interpolation=cv2.INTER_CUBIC))
+    x = torch.from_numpy(np.stack(ims).transpose(0, 3, 1, 2)).float()
+    return ims, x
+
+
+def run_both(images, name, args, extra=()):
+    ims, x = images
+    level_args = [torch.full((x.size(0), ), float(el)) for el in args]
+    out = func_dict[name](x, *level_args, *extra)
+    out_cv = np.stack([RA.func_dict[name](im, *args, *extra) for im in ims])
+    out_cv = torch.from_numpy(out_cv.transpose(0, 3, 1, 2)).float()
+    return (out - out_cv).abs()
+
+
+@pytest.mark.parametrize('name, args', [
+    ('AutoContrast', ()), ('Equalize', ()), ('Invert', ()),
+    ('Posterize', (3, )), ('Solarize', (70, )), ('SolarizeAdd', (60, )),
+    ('Color', (0.6, )), ('Contrast', (1.6, )), ('Brightness', (1.3, )),
+    ('Sharpness', (0.3, )),
+])
+def test_pixel_ops_match_cv2(images, name, args):
+    assert run_both(images, name, args).max().item() <= 1
+
+
+@pytest.mark.parametrize('name, val', [
+    ('Rotate', 20.), ('ShearX', 0.2), ('ShearY', -0.2),
+    ('TranslateX', 40.), ('TranslateY', -30.),
+])
+def test_geometric_ops_match_cv2(images, name, val):
+    diff = run_both(images, name, (val, ), (replace_value, ))
+    assert (diff > 1).float().mean().item() <= 1e-2
+
+
+def test_batch_augment_keeps_input(images):
+    _, x = images
+    x_in = x.clone()
+    out = BatchRandomAugment(2, 9)(x)
+    assert torch.equal(x, x_in)
+    assert out.shape == x.shape
+    assert out.min().item() >= 0 and out.max().item() <= 255
+
+    ims = x.to(torch.uint8)
+    out = BatchRandomAugment(2, 9)(ims)
+    assert out.dtype == torch.uint8
+
+
+def test_grouped_ops_match_per_sample(images):
+    ## ops without random sign, so each sample can be redone on its own
+    _, x = images
+    names = ['Equalize', None, 'Posterize', 'Equalize']
+    op_inds = torch.tensor([-1 if el is None else OP_NAMES.index(el) for el in names])
+    mags = torch.tensor([9., 9., 5., 7.])
+    out = apply_ops(x.clone(), op_inds, mags)
+    for i, name in enumerate(names):
+        ref = x[i:i + 1]
+        if not name is None:
+            ref = func_dict[name](ref, *arg_dict[name](mags[i:i + 1]))
+        assert torch.equal(out[i:i + 1], ref), name
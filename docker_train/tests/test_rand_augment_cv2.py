@@ -0,0 +1,29 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+import rand_augment_cv2 as RA
+
+
+def smooth_image(h, w, seed=0):
+    rng = np.random.RandomState(seed)
+    im = rng.randint(0, 256, (h // 8, w // 8, 3)).astype(np.uint8)
+    return cv2.resize(im, (w, h), interpolation=cv2.INTER_CUBIC)
+
+
+@pytest.mark.parametrize('chain', [
+    [('Contrast', 1.3), ('Brightness', 0.8)],
+    [('Solarize', 128), ('AutoContrast', ), ('Posterize', 3)],
+    [('Invert', ), ('Equalize', ), ('SolarizeAdd', 60, 128), ('Contrast', 0.6)],
+])
+def test_lut_chain_matches_sequential(chain):
+    img = smooth_image(320, 256)
+    out_seq = img
+    for name, *args in chain:
+        out_seq = RA.func_dict[name](out_seq, *args)
+    lut = RA.LUTChain(img)
+    for name, *args in chain: lut.append(name, *args)
+    out_lut = lut.apply()
+    diff = np.abs(out_seq.astype(np.float32) - out_lut.astype(np.float32))
+    assert diff.max() <= 1
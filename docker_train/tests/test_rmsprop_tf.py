@@ -0,0 +1,54 @@
+import copy
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import torch.nn as nn
+
+from rmsprop_tf import RMSpropTF
+
+
+def build_model():
+    return nn.Sequential(
+        nn.Conv2d(3, 8, 3, 1, 1), nn.BatchNorm2d(8), nn.ReLU(),
+        nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, 10))
+
+
+@pytest.mark.parametrize('opts', [
+    dict(momentum=0.9),
+    dict(momentum=0.9, lr_in_momentum=False),
+    dict(weight_decay=1e-4, decoupled_decay=True),
+    dict(weight_decay=1e-4),
+    dict(momentum=0.9, centered=True),
+])
+def test_foreach_matches_loop(opts):
+    torch.manual_seed(0)
+    model = build_model()
+    inten = torch.randn(4, 3, 16, 16)
+    models = [copy.deepcopy(model) for _ in range(2)]
+    optims = [RMSpropTF(el.parameters(), lr=1e-3, foreach=foreach, **opts)
+            for el, foreach in zip(models, (False, True))]
+    for _ in range(5):
+        for el, optim in zip(models, optims):
+            optim.zero_grad()
+            el(inten).sum().backward()
+            optim.step()
+    for p1, p2 in zip(models[0].parameters(), models[1].parameters()):
+        assert torch.allclose(p1, p2, atol=1e-6)
+
+
+def test_foreach_per_group_and_in_state_dict():
+    torch.manual_seed(0)
+    model = build_model()
+    params = list(model.parameters())
+    optim = RMSpropTF([{'params': params[:2]}, {'params': params[2:], 'foreach': False}],
+            lr=1e-3, momentum=0.9)
+    assert [group['foreach'] for group in optim.param_groups] == [True, False]
+    model(torch.randn(2, 3, 16, 16)).sum().backward()
+    optim.step()
+    state = optim.state_dict()
+    assert [group['foreach'] for group in state['param_groups']] == [True, False]
+    optim = RMSpropTF([{'params': params[:2]}, {'params': params[2:]}],
+            lr=1e-3, momentum=0.9, foreach=False)
+    optim.load_state_dict(state)
+    assert [group['foreach'] for group in optim.param_groups] == [True, False]
@@ -0,0 +1,71 @@
+import os
+import os.path as osp
+import importlib.util
+import pytest
+
+np = pytest.importorskip('numpy')
+
+## loaded on its own, importing the data package pulls in every dataset
+_spec = importlib.util.spec_from_file_location('sample_index', osp.join(
+    osp.dirname(osp.dirname(osp.abspath(__file__))), 'data', 'sample_index.py'))
+sample_index = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sample_index)
+SampleIndex = sample_index.SampleIndex
+
+
+def legacy_samples(txtpth, root):
+    ## list of tuples built by the dataset before SampleIndex
+    samples = []
+    with open(txtpth, 'r') as fr:
+        for line in fr.read().splitlines():
+            pth, lb = line.split(' ')
+            samples.append((osp.join(root, pth), int(lb)))
+    return samples
+
+
+@pytest.fixture
+def ann_file(tmp_path):
+    lines = [f'n{i % 7:08d}/img_{i}.JPEG {i % 7}' for i in range(50)]
+    txtpth = tmp_path / 'train.txt'
+    txtpth.write_text('\n'.join(lines) + '\n')
+    return str(txtpth)
+
+
+def test_matches_legacy_list(ann_file):
+    index = SampleIndex.from_ann_file(ann_file, 'root/train')
+    legacy = legacy_samples(ann_file, 'root/train')
+    assert len(index) == len(legacy)
+    for idx, (pth, lb) in enumerate(legacy):
+        assert index.get_path(idx) == pth
+        assert index.get_label(idx) == lb
+        assert index[idx] == (pth, lb)
+
+
+def test_separator_in_path(tmp_path):
+    ## the label is after the last separator
+    txtpth = tmp_path / 'train.txt'
+    txtpth.write_text('a/name with spaces.JPEG 3\n')
+    index = SampleIndex.from_ann_file(str(txtpth), 'root')
+    assert list(index) == [('root/a/name with spaces.JPEG', 3)]
+
+
+def test_cache_round_trip(ann_file):
+    index = SampleIndex.from_ann_file(ann_file, 'root', cache=True)
+    cache_pth = f'{ann_file}.index.npz'
+    assert osp.exists(cache_pth)
+    cached = SampleIndex.from_ann_file(ann_file, 'root', cache=True)
+    assert list(cached) == list(index)
+    ## cache is rebuilt once the annotation file changes
+    with open(ann_file, 'a') as fw: fw.write('new/img.JPEG 5\n')
+    os.utime(ann_file, ns=(0, 0))
+    updated = SampleIndex.from_ann_file(ann_file, 'root', cache=True)
+    assert len(updated) == len(index) + 1
+    assert updated[-1] == ('root/new/img.JPEG', 5)
+
+
+def test_empty_ann_file(tmp_path):
+    txtpth = tmp_path / 'val.txt'
+    txtpth.write_text('')
+    index = SampleIndex.from_ann_file(str(txtpth))
+    assert len(index) == 0
+    assert list(index) == []
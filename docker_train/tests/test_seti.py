@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('cv2')
+pytest.importorskip('albumentations')
+
+from data.seti import read_cadence
+
+
+def readimg_legacy(impth):
+    ## per-file read of SETI before the strided copy
+    im_on = np.load(impth)[[0, 2, 4]] # (3, 273, 256)
+    im_off = np.load(impth)[[1, 3, 5]] # (3, 273, 256)
+    im_on = np.vstack(im_on).T[..., np.newaxis] # (256, 819, 1)
+    im_off = np.vstack(im_off).T[..., np.newaxis] # (256, 819, 1)
+    im = np.concatenate([im_on, im_off], axis=2)
+    return im.astype('f') # (256, 819, 2)
+
+
+@pytest.mark.parametrize('dtype', [np.float16, np.float32])
+def test_read_cadence_matches_legacy(tmp_path, dtype):
+    rng = np.random.RandomState(0)
+    pths = []
+    for i in range(3):
+        pths.append(str(tmp_path / f'{i}.npy'))
+        np.save(pths[-1], rng.randn(6, 273, 256).astype(dtype))
+    buf = None
+    for pth in pths:
+        ref = readimg_legacy(pth)
+        out = read_cadence(pth)
+        assert out.dtype == np.float32 and out.shape == (256, 819, 2)
+        assert np.array_equal(out, ref)
+        ## the reused buffer gives the same result
+        buf_in = buf
+        buf = read_cadence(pth, buf)
+        assert buf_in is None or buf is buf_in
+        assert np.array_equal(buf, ref)
@@ -0,0 +1,92 @@
+import json
+import os.path as osp
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('cv2')
+pytest.importorskip('albumentations')
+
+from data.seti import read_cadence
+from data.seti_store import pack_seti_store, SETIStore
+
+
+N_SAMPLES, N_FOLDS, SHAPE = 11, 3, (6, 5, 4)
+
+
+@pytest.fixture
+def seti_root(tmp_path):
+    ## same layout as datasets/seti, folds written like gen_folds.py, so the
+    ## last N_SAMPLES % N_FOLDS samples are in no val fold
+    rng = np.random.RandomState(0)
+    (tmp_path / 'train').mkdir()
+    (tmp_path / 'folds').mkdir()
+    lines = []
+    for i in range(N_SAMPLES):
+        np.save(tmp_path / 'train' / f'{i}.npy',
+                (rng.randn(*SHAPE) * 3 + i).astype(np.float16))
+        lines.append(f'train/{i}.npy,{i % 2}')
+    (tmp_path / 'train_all.txt').write_text('\n'.join(lines))
+    perm = rng.permutation(N_SAMPLES)
+    size = N_SAMPLES // N_FOLDS
+    for ind in range(N_FOLDS):
+        val_lines = [lines[el] for el in perm[ind * size:(ind + 1) * size]]
+        (tmp_path / 'folds' / f'val_fold_{ind + 1}.txt').write_text('\n'.join(val_lines))
+    folds = np.zeros(N_SAMPLES, dtype=np.int64)
+    for ind in range(N_FOLDS):
+        folds[perm[ind * size:(ind + 1) * size]] = ind + 1
+    return str(tmp_path), folds
+
+
+def test_pack_folds_and_stats(seti_root):
+    root, folds = seti_root
+    meta = pack_seti_store(root, 'train_all.txt', dtype='float32', chunk_size=4)
+    store_root = osp.join(root, 'store')
+    assert np.array_equal(np.load(osp.join(store_root, 'train_folds.npy')), folds)
+    assert meta['n_folds'] == N_FOLDS
+    assert meta['n_train_only'] == N_SAMPLES % N_FOLDS
+    with open(osp.join(store_root, 'train_meta.json'), 'r') as fr:
+        assert json.load(fr) == meta
+
+    arrs = np.stack([np.load(osp.join(root, 'train', f'{i}.npy'))
+        for i in range(N_SAMPLES)]).astype(np.float32)
+    cadences = np.load(osp.join(store_root, 'train_cadences.npy'))
+    assert np.array_equal(cadences, arrs)
+    labels = np.load(osp.join(store_root, 'train_labels.npy'))
+    assert np.array_equal(labels, np.arange(N_SAMPLES) % 2)
+    for ch in range(2):
+        vals = arrs[:, ch::2].astype(np.float64)
+        assert np.isclose(meta['stats']['min'][ch], vals.min())
+        assert np.isclose(meta['stats']['max'][ch], vals.max())
+        assert np.isclose(meta['stats']['mean'][ch], vals.mean())
+        assert np.isclose(meta['stats']['std'][ch], vals.std())
+
+
+def test_store_fold_selection(seti_root):
+    root, folds = seti_root
+    pack_seti_store(root, 'train_all.txt', dtype='float16')
+    train_only = set(np.nonzero(folds == 0)[0].tolist())
+    assert len(train_only) > 0
+    for fold in range(1, N_FOLDS + 1):
+        ds_train = SETIStore(root, 'train', cropsize=8, fold=fold)
+        ds_val = SETIStore(root, 'val', cropsize=8, fold=fold)
+        train_inds, val_inds = set(ds_train.samples.tolist()), set(ds_val.samples.tolist())
+        assert val_inds == set(np.nonzero(folds == fold)[0].tolist())
+        assert train_inds | val_inds == set(range(N_SAMPLES))
+        assert len(train_inds & val_inds) == 0
+        assert train_only <= train_inds
+
+        ## fold=None keeps all samples, get_fold_inds gives the same split
+        ds_all = SETIStore(root, 'val', cropsize=8, fold=None)
+        assert set(ds_all.get_fold_inds(fold).tolist()) == val_inds
+        ds_all = SETIStore(root, 'train', cropsize=8, fold=None)
+        assert set(ds_all.get_fold_inds(fold).tolist()) == train_inds
+
+    ds = SETIStore(root, 'val', cropsize=8, fold=1)
+    idx = int(ds.samples[0])
+    im = ds.load_img(0)
+    ref = read_cadence(osp.join(root, 'train', f'{idx}.npy'))
+    assert np.array_equal(im, ref)
+    with pytest.raises(AssertionError):
+        SETIStore(root, 'train', cropsize=8, fold=0)
@@ -0,0 +1,114 @@
+import warnings
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import torch.nn as nn
+from torch.overrides import TorchFunctionMode
+
+from meters import DeviceAvgMeter
+from ops import EMA, MixUper, CutMixer
+from train_step import train_step, forward_backward
+
+
+## tensor methods that hand a device value to python, each one waits for
+## the device when the tensor is on a gpu
+HOST_READS = {'item', 'tolist', 'numpy', 'cpu', '__float__', '__int__',
+        '__bool__', '__index__'}
+
+
+class HostReadCounter(TorchFunctionMode):
+
+    def __init__(self):
+        super(HostReadCounter, self).__init__()
+        self.n_reads = 0
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if getattr(func, '__name__', None) in HOST_READS: self.n_reads += 1
+        return func(*args, **(kwargs or {}))
+
+
+def build_model():
+    return nn.Sequential(
+        nn.Conv2d(3, 8, 3, 1, 1), nn.BatchNorm2d(8), nn.ReLU(),
+        nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, 10))
+
+
+@pytest.mark.parametrize('accum_steps', [2, 4])
+def test_accum_grads_match_full_batch(accum_steps):
+    ## no bn, its batch statistics would differ between micro-batches
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        nn.Conv2d(3, 8, 3, 1, 1), nn.ReLU(),
+        nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, 10))
+    crit = nn.CrossEntropyLoss()
+    scaler = torch.amp.GradScaler('cpu', enabled=False)
+    im, lb = torch.randn(16, 3, 16, 16), torch.randint(0, 10, (16, ))
+    losses, grads = [], []
+    for k in (1, accum_steps):
+        model.zero_grad()
+        losses.append(forward_backward(model, crit, im, lb, scaler, k))
+        grads.append([p.grad.clone() for p in model.parameters()])
+    assert torch.allclose(losses[0], losses[1], atol=1e-6)
+    for g1, g2 in zip(*grads):
+        assert torch.allclose(g1, g2, atol=1e-6)
+
+
+def run_epoch(scaler, n_iters, print_freq, device='cpu', accum_steps=2):
+    ## same order of calls as the loop of train.py
+    torch.manual_seed(0)
+    model = build_model().to(device)
+    optim = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    ema = EMA(model, 0.999)
+    meter = DeviceAvgMeter()
+    mixuper, cutmixer = MixUper(0.2), CutMixer(1.)
+    crit = nn.CrossEntropyLoss()
+    clip_grad = lambda: nn.utils.clip_grad_norm_(model.parameters(), 10.)
+    ims = torch.randn(n_iters, 8, 3, 16, 16, device=device)
+    lbs = torch.randint(0, 10, (n_iters, 8), device=device)
+    counter = HostReadCounter()
+    with counter:
+        for idx in range(n_iters):
+            im = ims[idx].clone()
+            lb = nn.functional.one_hot(lbs[idx], 10).float()
+            im, lb = mixuper(im, lb)
+            im, lb = cutmixer(im, lb)
+            optim.zero_grad()
+            loss = train_step(model, crit, optim, scaler, im, lb, accum_steps,
+                    clip_grad=clip_grad)
+            ema.update_params()
+            meter.update(loss)
+            if (idx + 1) % print_freq == 0: meter.get()
+    return counter.n_reads
+
+
+def test_host_reads_at_print_freq_only():
+    n_iters, print_freq = 20, 5
+    scaler = torch.amp.GradScaler('cpu', enabled=False)
+    assert run_epoch(scaler, n_iters, print_freq) == n_iters // print_freq
+
+
+def test_enabled_scaler_reads_once_per_step():
+    ## the inf/nan check of GradScaler.step is the only per step read, this
+    ## is why train.py enables the scaler with amp only
+    n_iters, print_freq = 20, 5
+    scaler = torch.amp.GradScaler('cpu', enabled=True)
+    n_reads = run_epoch(scaler, n_iters, print_freq)
+    assert n_reads == n_iters + n_iters // print_freq
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs cuda')
+def test_cuda_syncs_at_print_freq_only():
+    n_iters, print_freq = 20, 5
+    scaler = torch.amp.GradScaler('cuda', enabled=False)
+    run_epoch(scaler, 2, 1, device='cuda') # warm up lazy inits
+    torch.cuda.set_sync_debug_mode('warn')
+    try:
+        with warnings.catch_warnings(record=True) as records:
+            warnings.simplefilter('always')
+            run_epoch(scaler, n_iters, print_freq, device='cuda')
+    finally:
+        torch.cuda.set_sync_debug_mode('default')
+    n_syncs = sum('synchroniz' in str(el.message) for el in records)
+    assert n_syncs == n_iters // print_freq
@@ -0,0 +1,82 @@
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('torch')
+
+import transforms as T
+
+
+def smooth_image(h, w, seed=0):
+    rng = np.random.RandomState(seed)
+    im = rng.randint(0, 256, (h // 8, w // 8, 3)).astype(np.uint8)
+    return cv2.resize(im, (w, h), interpolation=cv2.INTER_CUBIC)
+
+
+def test_fused_train_transform_matches_separate():
+    img = smooth_image(375, 500)
+    mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    trans = T.Compose([
+        T.RandomResizedCrop(224),
+        T.RandomHorizontalFlip(),
+        T.ToTensor(),
+        T.PCANoise(0.1),
+        T.Normalize(mean, std)
+    ])
+    trans_fused = T.RandomResizedCropFlipNormalize(224, mean, std, pca_std=0.1)
+    out_buf = np.empty((3, 224, 224), dtype=np.float32)
+    for seed in range(20):
+        random.seed(seed)
+        np.random.seed(seed)
+        out = trans(img)
+        random.seed(seed)
+        np.random.seed(seed)
+        out_fused = trans_fused(img, out=out_buf)
+        assert out_fused is out_buf
+        assert np.abs(out - out_fused).max() < 1e-5
+
+
+@pytest.fixture(scope='module')
+def jpeg_buf():
+    ## features of ~150 pixels, so that a crop box off by a few pixels at
+    ## full resolution does not change the resized crop much
+    rng = np.random.RandomState(1)
+    img = rng.randint(0, 256, (12, 16, 3)).astype(np.uint8)
+    img = cv2.resize(img, (2400, 1800), interpolation=cv2.INTER_CUBIC)
+    _, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return buf.reshape(-1)
+
+
+def test_reduced_decode_crop_geometry(jpeg_buf):
+    size, factors = (224, 224), set()
+    for seed in range(50):
+        random.seed(seed)
+        im, (i, j, h, w), factor = T.decode_random_crop(jpeg_buf, size)
+        random.seed(seed)
+        i0, j0, h0, w0 = T.RandomResizedCrop.get_params_by_size(1800, 2400,
+                (0.08, 1.0), (3. / 4., 4. / 3.))
+        ## largest factor at which the crop is no smaller than the output
+        expect = max([1, ] + [el for el in (2, 4, 8)
+            if h0 >= size[0] * el and w0 >= size[1] * el])
+        assert factor == expect
+        assert im.shape[:2] == (1800 // factor, 2400 // factor)
+        assert h >= size[0] or factor == 1
+        assert w >= size[1] or factor == 1
+        for v, v0 in ((i, i0), (j, j0), (h, h0), (w, w0)):
+            assert abs(v * factor - v0) <= factor
+        factors.add(factor)
+    assert len(factors) > 1
+
+
+def test_reduced_decode_close_to_full_decode(jpeg_buf):
+    full = cv2.imdecode(jpeg_buf, cv2.IMREAD_COLOR)
+    for seed in range(20):
+        random.seed(seed)
+        out = T.decode_random_resized_crop(jpeg_buf, (224, 224))
+        random.seed(seed)
+        i, j, h, w = T.RandomResizedCrop.get_params(full, (0.08, 1.0), (3. / 4., 4. / 3.))
+        ref = cv2.resize(full[i:i+h, j:j+w, :], dsize=(224, 224),
+                interpolation=cv2.INTER_CUBIC)
+        assert out.shape == ref.shape
+        assert np.abs(out.astype(np.float32) - ref.astype(np.float32)).mean() < 4.
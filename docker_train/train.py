@@ -8,19 +8,24 @@ import cv2
 import numpy as np
 import random
 import math
+import json
+from copy import deepcopy
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
 import torch.distributed as dist
 import torch.cuda.amp as amp
 
-from cbl_models import build_model
+from cbl_models import build_model, FlatParams
 from data import get_dataset
 from eval import eval_model
 from config import set_cfg_from_file
-from meters import TimeMeter, AvgMeter
+from meters import TimeMeter, AvgMeter, DeviceAvgMeter
+from checkpoint import (AsyncCheckpointer, load_latest_checkpoint,
+        get_rng_states, set_rng_states)
 from logger import setup_logger
+from train_step import train_step
 from ops import EMA, MixUper, CutMixer
 from pytorch_loss import LabelSmoothSoftmaxCEV3, OnehotEncoder
 from rmsprop_tf import RMSpropTF
@@ -106,6 +111,10 @@ def parse_args():
                        type=int,
                        default=-1,)
     parse.add_argument('--config', dest='config', type=str, default='resnet50.py',)
+    parse.add_argument('--resume', dest='resume', action='store_true',
+            help='continue from the latest checkpoint in ./res/ckpt*')
+    parse.add_argument('--folds', dest='folds', type=int, nargs='+', default=None,
+            help='train these folds one by one in this process, e.g. --folds 1 2 3 4 5')
     return parse.parse_args()
 
 args = parse_args()
@@ -135,7 +144,7 @@ def cal_l2_loss(model, weight_decay):
     return 0.5 * l2loss
 
 
-def set_optimizer(model, opt_type, opt_args, schdlr_type, schdlr_args):
+def get_wd_params(model):
     if hasattr(model, 'get_params'):
         wd_params, non_wd_params = model.get_params()
     else:
@@ -148,6 +157,15 @@ def set_optimizer(model, opt_type, opt_args, schdlr_type, schdlr_args):
                 non_wd_params.append(param)
             else:
                 print(name)
+    return wd_params, non_wd_params
+
+
+def set_optimizer(model, opt_type, opt_args, schdlr_type, schdlr_args,
+        flat_params=None):
+    if flat_params is None:
+        wd_params, non_wd_params = get_wd_params(model)
+    else:
+        wd_params, non_wd_params = flat_params.groups[:1], flat_params.groups[1:]
     params_list = [
         {'params': wd_params},
         {'params': non_wd_params, 'weight_decay': 0},
@@ -169,10 +187,51 @@ def set_optimizer(model, opt_type, opt_args, schdlr_type, schdlr_args):
 
 
 def main():
+    dataset_train = get_dataset(cfg.dataset_args, mode='train')
+    dataset_eval = get_dataset(cfg.dataset_args, mode='val')
+    train(dataset_train, dataset_eval)
+
+
+def main_folds(folds):
+    ## datasets are built once over all samples, each fold takes subsets of
+    ## them, and model/optimizer/scheduler/ema are rebuilt by train()
+    ds_args = deepcopy(cfg.dataset_args)
+    ds_args.update(getattr(cfg, 'fold_dataset_args', {}))
+    dataset_all_train = get_dataset(ds_args, mode='train')
+    dataset_all_eval = get_dataset(ds_args, mode='val')
+    logger = logging.getLogger()
+
+    ## fold 0 of SETIStore holds the samples that are in no val fold
+    assert all(fold >= 1 for fold in folds), 'folds are 1 based'
+    summary = {}
+    for fold in folds:
+        logger.info(f'train fold {fold}')
+        dataset_train = Subset(dataset_all_train,
+                dataset_all_train.get_fold_inds(fold))
+        dataset_eval = Subset(dataset_all_eval,
+                dataset_all_eval.get_fold_inds(fold))
+        summary[fold] = train(dataset_train, dataset_eval, suffix=f'_{fold}')
+        logger.info(f'fold {fold} result: {summary[fold]}')
+
+    ## folds without eval result (resumed from checkpoints saved before
+    ## results were stored) are left out of the mean
+    results = [el for el in summary.values() if len(el) > 0]
+    skipped = [fold for fold, el in summary.items() if len(el) == 0]
+    if len(skipped) > 0:
+        logger.warning(f'folds {skipped} have no eval result, not in the mean')
+    keys = set.intersection(*[set(el.keys()) for el in results]) if results else set()
+    summary['mean'] = {k: sum(el[k] for el in results) / len(results)
+            for k in keys}
+    logger.info(f'folds mean result: {summary["mean"]}')
+    if dist.get_rank() == 0:
+        with open('./res/folds_summary.json', 'w') as fw:
+            json.dump(summary, fw, indent=2)
+
+
+def train(dataset_train, dataset_eval, suffix=''):
     num_classes = cfg.model_args['n_classes']
 
     ## dataloader
-    dataset_train = get_dataset(cfg.dataset_args, mode='train')
     sampler_train = torch.utils.data.distributed.DistributedSampler(
         dataset_train, shuffle=True)
     batch_sampler_train = torch.utils.data.sampler.BatchSampler(
@@ -185,7 +244,6 @@ def main():
         num_workers=cfg.num_workers, pin_memory=True,
         worker_init_fn=worker_init_fn
     )
-    dataset_eval = get_dataset(cfg.dataset_args, mode='val')
     sampler_val = torch.utils.data.distributed.DistributedSampler(
         dataset_eval, shuffle=False)
     batch_sampler_val = torch.utils.data.sampler.BatchSampler(
@@ -195,7 +253,14 @@ def main():
         dataset_eval, batch_sampler=batch_sampler_val,
         num_workers=4, pin_memory=True
     )
+    ## augmentations applied on the device to the whole batch, if any
+    batch_trans_train = getattr(dataset_train.dataset
+            if isinstance(dataset_train, Subset) else dataset_train,
+            'batch_trans_train', None)
     n_iters_per_epoch = len(dataset_train) // cfg.n_gpus // cfg.batchsize
+    ## each batch of cfg.batchsize is split into accum_steps micro-batches
+    accum_steps = getattr(cfg, 'accum_steps', 1)
+    assert cfg.batchsize % accum_steps == 0
     n_iters = cfg.n_epoches * n_iters_per_epoch
 
 
@@ -215,16 +280,23 @@ def main():
         #  crit = LabelSmoothSoftmaxCEV3(cfg.lb_smooth)
         #  crit = SoftmaxCrossEntropyV1()
 
-    ## optimizer
-    optim, scheduler = set_optimizer(model,
-            cfg.opt_type, cfg.opt_args, cfg.schdlr_type, cfg.schdlr_args)
+    ## optimizer, with use_flat_params the two weight decay groups are
+    ## flat buffers that the model parameters are views of
+    flat_params = None
+    if getattr(cfg, 'use_flat_params', False):
+        flat_params = FlatParams(*get_wd_params(model))
+    optim, scheduler = set_optimizer(model, cfg.opt_type, cfg.opt_args,
+            cfg.schdlr_type, cfg.schdlr_args, flat_params)
     scheduler.update_by_iter(n_iters_per_epoch)
 
     ## mixed precision
-    scaler = amp.GradScaler()
+    ## scaler.step reads the inf/nan check on the host, one sync per
+    ## iteration, so the scaler is only enabled with amp. Without amp, steps
+    ## with inf/nan gradients are not skipped any more, see CHANGELOG.md
+    scaler = amp.GradScaler(enabled=cfg.use_mixed_precision)
 
     ## ema
-    ema = EMA(model, cfg.ema_alpha)
+    ema = EMA(model, cfg.ema_alpha, **getattr(cfg, 'ema_args', {}))
 
     ## ddp training
     local_rank = dist.get_rank()
@@ -234,7 +306,7 @@ def main():
 
     ## log meters
     time_meter = TimeMeter(n_iters)
-    loss_meter = AvgMeter()
+    loss_meter = DeviceAvgMeter()
     logger = logging.getLogger()
 
     # for mixup
@@ -243,14 +315,38 @@ def main():
     mixuper = MixUper(cfg.mixup_alpha)
     cutmixer = CutMixer(cfg.cutmix_beta)
 
+    ## checkpoints, rng states are restored last, right before the loop
+    ckpt_dir = f'./res/ckpt{suffix}'
+    checkpointer = AsyncCheckpointer(ckpt_dir, getattr(cfg, 'ckpt_keep', 2))
+    ckpt_every = getattr(cfg, 'ckpt_every', 1)
+    train_objs = dict(model=model.module, ema=ema, optim=optim, scaler=scaler,
+            scheduler=scheduler, time_meter=time_meter, loss_meter=loss_meter)
+    start_epoch, metric_dict = 0, {}
+    if args.resume:
+        state = load_latest_checkpoint(ckpt_dir)
+        if not state is None:
+            start_epoch, metric_dict = load_train_state(state, train_objs)
+            logger.info(f'resume from epoch {start_epoch}')
+
+    ## called by train_step on the unscaled gradients
+    if flat_params is None:
+        clip_grad = lambda: nn.utils.clip_grad_norm_(
+                model.parameters(), cfg.grad_clip_norm)
+    else:
+        clip_grad = lambda: flat_params.clip_grad_norm_(cfg.grad_clip_norm)
+
+    ## warn on every host sync of the loop, to find the ones left
+    if getattr(cfg, 'sync_debug', False): torch.cuda.set_sync_debug_mode('warn')
+
     ## train loop
-    for e in range(cfg.n_epoches):
+    for e in range(start_epoch, cfg.n_epoches):
         logger.info(f'train epoch {e + 1}')
         sampler_train.set_epoch(e)
         np.random.seed(init_seed + e)
         model.train()
         for idx, (im, lb) in enumerate(dl_train):
             im, lb= im.cuda(non_blocking=True), lb.cuda(non_blocking=True)
+            if batch_trans_train is not None: im = batch_trans_train(im)
 
             if num_classes > 1 and (cfg.use_mixup or cfg.use_cutmix):
                 lb = label_encoder(lb)
@@ -260,27 +356,24 @@ def main():
             if cfg.use_cutmix:
                 im, lb = cutmixer(im, lb)
 
-            optim.zero_grad()
-            with amp.autocast(enabled=cfg.use_mixed_precision):
-                logits = model(im)
-                loss = crit(logits, lb) #+ cal_l2_loss(model, weight_decay)
-            scaler.scale(loss).backward()
-
-            scaler.unscale_(optim)
-            nn.utils.clip_grad_norm_(model.parameters(), cfg.grad_clip_norm)
-
-            scaler.step(optim)
-            scaler.update()
-            torch.cuda.synchronize()
+            if flat_params is None:
+                optim.zero_grad()
+            else:
+                optim.zero_grad(set_to_none=False)
+            ## accum_steps micro-batches, only the last one all-reduces
+            loss = train_step(model, crit, optim, scaler, im, lb, accum_steps,
+                    cfg.use_mixed_precision, clip_grad)
             ema.update_params()
             time_meter.update()
-            loss_meter.update(loss.item())
+            loss_meter.update(loss)
             if (idx + 1) % cfg.print_freq == 0:
+                ## reading the loss waits for the device, so time it after
+                loss_avg = loss_meter.get()[0]
                 t_intv, eta = time_meter.get()
                 lr_log = scheduler.get_lr()
                 lr_log = sum(lr_log) / len(lr_log)
                 msg = 'epoch: {}, iter: {}, lr: {:.4f}, loss: {:.4f}, time: {:.2f}, eta: {}'.format(
-                    e + 1, idx + 1, lr_log, loss_meter.get()[0], t_intv, eta)
+                    e + 1, idx + 1, lr_log, loss_avg, t_intv, eta)
                 logger.info(msg)
             scheduler.step()
         torch.cuda.empty_cache()
@@ -290,18 +383,43 @@ def main():
             msg = f'epoch {e + 1} eval result: {metric_dict}'
             #  msg = 'epoch {} eval result: naive_acc1: {:.4}, naive_acc5: {:.4}, ema_acc1: {:.4}, ema_acc5: {:.4}'.format(e + 1, acc_1, acc_5, acc_1_ema, acc_5_ema)
             logger.info(msg)
+        if (e + 1) % ckpt_every == 0 or e + 1 == cfg.n_epoches:
+            state = get_train_state(e + 1, train_objs, metric_dict)
+            if dist.get_rank() == 0: checkpointer.save(state, e + 1)
+    checkpointer.close()
     if dist.is_initialized() and dist.get_rank() == 0:
         #  torch.save(model.module.state_dict(), './res/model_final_naive.pth')
         #  torch.save(ema.ema_model.state_dict(), './res/model_final_ema.pth')
-        torch.save(model.module.get_states(), './res/model_final_naive.pth')
-        torch.save(ema.ema_model.get_states(), './res/model_final_ema.pth')
+        torch.save(model.module.get_states(), f'./res/model_final_naive{suffix}.pth')
+        torch.save(ema.materialize().get_states(), f'./res/model_final_ema{suffix}.pth')
+        ema.release()
+    return metric_dict
+
+
+def get_train_state(epoch, train_objs, metric_dict):
+    ## every rank has its own rng streams, they are gathered to rank 0
+    rng_states = [None for _ in range(dist.get_world_size())]
+    dist.all_gather_object(rng_states, get_rng_states())
+    state = {k: v.state_dict() for k, v in train_objs.items()}
+    ## last eval result, returned by train() when resuming a finished run
+    state.update(dict(epoch=epoch, rng=rng_states, metrics=metric_dict))
+    return state
+
+
+def load_train_state(state, train_objs):
+    for k, v in train_objs.items(): v.load_state_dict(state[k])
+    set_rng_states(state['rng'][dist.get_rank()])
+    return state['epoch'], state.get('metrics', {})
 
 
 def evaluate(ema, dl_eval):
-    model = ema.ema_model
-    metric_dict = eval_model(model, dl_eval, cfg.metric)
-    model = ema.model
-    metric_dict_ema = eval_model(model, dl_eval, cfg.metric)
+    ## one pass over dl_eval for both naive and ema model. The keys without
+    ## suffix are the naive model and `_ema` the ema model; before this
+    ## they were the other way round, see CHANGELOG.md
+    metric_args = getattr(cfg, 'metric_args', None)
+    metric_dict, metric_dict_ema = eval_model(
+            [ema.model, ema.materialize()], dl_eval, cfg.metric, metric_args)
+    ema.release()
     metric_dict_ema = {f'{k}_ema': v for k,v in metric_dict_ema.items()}
 
     metric_dict.update(metric_dict_ema)
@@ -324,5 +442,8 @@ def init_dist(args):
 if __name__ == '__main__':
     init_dist(args)
     setup_logger(cfg.model_args['model_type'], './res/')
-    main()
+    if args.folds is None:
+        main()
+    else:
+        main_folds(args.folds)
     dist.barrier()
@@ -0,0 +1,51 @@
+from contextlib import nullcontext
+
+import torch
+import torch.cuda.amp as amp
+
+
+'''
+    one optimization step of train.py, apart from data loading and the
+    augmentations on the device, so that it can be run without a process
+    group or a gpu.
+
+    Host syncs: nothing here reads a device value, except `scaler.step` when
+    the scaler is enabled, which reads the inf/nan check of the gradients
+    once per step to decide whether the optimizer step is skipped.
+'''
+
+
+def forward_backward(model, crit, im, lb, scaler, accum_steps=1,
+        use_mixed_precision=False):
+    '''
+        split the batch into `accum_steps` micro-batches and accumulate their
+        gradients, with ddp only the last micro-batch all-reduces. Returns the
+        loss of the whole batch, detached and on the device.
+    '''
+    no_sync = getattr(model, 'no_sync', nullcontext)
+    loss = 0
+    for step, (im_mb, lb_mb) in enumerate(zip(
+            im.chunk(accum_steps), lb.chunk(accum_steps))):
+        is_last = step == accum_steps - 1
+        with nullcontext() if is_last else no_sync():
+            with amp.autocast(enabled=use_mixed_precision):
+                logits = model(im_mb)
+                loss_mb = crit(logits, lb_mb) / accum_steps
+            scaler.scale(loss_mb).backward()
+        loss = loss + loss_mb.detach()
+    return loss
+
+
+def train_step(model, crit, optim, scaler, im, lb, accum_steps=1,
+        use_mixed_precision=False, clip_grad=None):
+    '''
+        zero_grad is left to the caller, `clip_grad` is called on the
+        unscaled gradients before the optimizer step
+    '''
+    loss = forward_backward(model, crit, im, lb, scaler, accum_steps,
+            use_mixed_precision)
+    scaler.unscale_(optim)
+    if not clip_grad is None: clip_grad()
+    scaler.step(optim)
+    scaler.update()
+    return loss
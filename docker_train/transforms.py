@@ -4,6 +4,7 @@ import math
 import numbers
 import warnings
 import collections
+import functools
 import cv2
 import numpy as np
 
@@ -40,6 +41,19 @@ def resize(img, size, interpolation=cv2.INTER_CUBIC):
     return output
 
 
+## tables are memoized by factor rounded to 3 decimals
+@functools.lru_cache(maxsize=4096)
+def _contrast_table(contrast_factor):
+    table = (np.arange(256) - 74) * contrast_factor + 74
+    return table.clip(0, 255).astype('uint8')
+
+
+@functools.lru_cache(maxsize=4096)
+def _brightness_table(brightness_factor):
+    table = np.arange(256) * brightness_factor
+    return table.clip(0, 255).astype('uint8')
+
+
 def adjust_contrast(img, contrast_factor):
     """Adjust contrast of an mage.
     Args:
@@ -54,7 +68,7 @@ def adjust_contrast(img, contrast_factor):
     # it's because you have to change dtypes multiple times
     if not _is_numpy_image(img):
         raise TypeError('img should be numpy Image. Got {}'.format(type(img)))
-    table = np.array([ (i-74)*contrast_factor+74 for i in range (0,256)]).clip(0,255).astype('uint8')
+    table = _contrast_table(round(contrast_factor, 3))
     # enhancer = ImageEnhance.Contrast(img)
     # img = enhancer.enhance(contrast_factor)
     if img.shape[2]==1:
@@ -99,7 +113,7 @@ def adjust_brightness(img, brightness_factor):
     """
     if not _is_numpy_image(img):
         raise TypeError('img should be numpy Image. Got {}'.format(type(img)))
-    table = np.array([ i*brightness_factor for i in range (0,256)]).clip(0,255).astype('uint8')
+    table = _brightness_table(round(brightness_factor, 3))
     # same thing but a bit slower
     # cv2.convertScaleAbs(img, alpha=brightness_factor, beta=0)
     if img.shape[2]==1:
@@ -139,8 +153,16 @@ class RandomResizedCrop(object):
             tuple: params (i, j, h, w) to be passed to ``crop`` for a random
                 sized crop.
         """
+        return RandomResizedCrop.get_params_by_size(
+                img.shape[0], img.shape[1], scale, ratio)
+
+    @staticmethod
+    def get_params_by_size(H, W, scale, ratio):
+        '''
+            same as get_params, with the image size (H, W) instead of image
+        '''
         for attempt in range(10):
-            area = img.shape[0] * img.shape[1]
+            area = H * W
             target_area = random.uniform(*scale) * area
             aspect_ratio = random.uniform(*ratio)
 
@@ -150,15 +172,15 @@ class RandomResizedCrop(object):
             if random.random() < 0.5:
                 w, h = h, w
 
-            if w <= img.shape[1] and h <= img.shape[0]:
-                i = random.randint(0, img.shape[0] - h)
-                j = random.randint(0, img.shape[1] - w)
+            if w <= W and h <= H:
+                i = random.randint(0, H - h)
+                j = random.randint(0, W - w)
                 return i, j, h, w
 
         # Fallback
-        w = min(img.shape[0], img.shape[1])
-        i = (img.shape[0] - w) // 2
-        j = (img.shape[1] - w) // 2
+        w = min(H, W)
+        i = (H - w) // 2
+        j = (W - w) // 2
         return i, j, w, w
 
     def __call__(self, img):
@@ -176,6 +198,102 @@ class RandomResizedCrop(object):
         return img
 
 
+def jpeg_size(buf):
+    '''
+        (H, W) read from the SOF marker of encoded jpeg bytes, None if buf
+        is not jpeg or the marker is not found
+    '''
+    n = len(buf)
+    if n < 4 or buf[0] != 0xFF or buf[1] != 0xD8: return None
+    pos = 2
+    while pos + 9 < n:
+        if buf[pos] != 0xFF: return None
+        marker = buf[pos + 1]
+        if marker == 0xFF: # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and not marker in (0xC4, 0xC8, 0xCC):
+            H = (int(buf[pos + 5]) << 8) + int(buf[pos + 6])
+            W = (int(buf[pos + 7]) << 8) + int(buf[pos + 8])
+            return H, W
+        pos += 2 + (int(buf[pos + 2]) << 8) + int(buf[pos + 3])
+    return None
+
+
+reduced_decode_flags = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def decode_random_crop(buf, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+    '''
+        decode encoded image bytes for RandomResizedCrop to `size`, returns
+        the decoded BGR image, the crop box (i, j, h, w) on it and the
+        reduction factor of decoding. The crop is drawn from the size in the
+        jpeg header, then the image is decoded at 1/2, 1/4 or 1/8 scale if
+        the crop is still no smaller than `size` at that scale, and the crop
+        box is mapped onto the reduced image. Crop parameters are drawn the
+        same way as RandomResizedCrop, only the decoded resolution changes.
+    '''
+    oh, ow = size
+    hw = jpeg_size(buf)
+    im, factor = None, 1
+    if not hw is None:
+        H, W = hw
+        i, j, h, w = RandomResizedCrop.get_params_by_size(H, W, scale, ratio)
+        for fac in (8, 4, 2):
+            if h >= oh * fac and w >= ow * fac:
+                factor = fac
+                break
+        if factor > 1:
+            im = cv2.imdecode(buf, reduced_decode_flags[factor])
+        else:
+            im = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        dh, dw = im.shape[:2]
+        # exif rotation makes decoded size differ from header size
+        if abs(dh - H / factor) > 1 or abs(dw - W / factor) > 1:
+            if factor > 1: im = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+            hw, factor = None, 1
+        else:
+            sy, sx = dh / H, dw / W
+            i, j = min(int(i * sy), dh - 1), min(int(j * sx), dw - 1)
+            h = min(max(1, int(round(h * sy))), dh - i)
+            w = min(max(1, int(round(w * sx))), dw - j)
+    if hw is None:
+        if im is None: im = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        i, j, h, w = RandomResizedCrop.get_params(im, scale, ratio)
+    return im, (i, j, h, w), factor
+
+
+def decode_random_resized_crop(buf, size, scale=(0.08, 1.0),
+        ratio=(3. / 4., 4. / 3.), interpolation=cv2.INTER_CUBIC, dst=None):
+    '''
+        decode encoded image bytes and do RandomResizedCrop, output is BGR,
+        see decode_random_crop
+    '''
+    im, (i, j, h, w), _ = decode_random_crop(buf, size, scale, ratio)
+    im = cv2.resize(im[i:i+h, j:j+w, :], dsize=(size[1], size[0]), dst=dst,
+            interpolation=interpolation)
+    return im
+
+
+class DecodeRandomResizedCrop(RandomResizedCrop):
+    '''
+        RandomResizedCrop on encoded image bytes, decodes at reduced
+        resolution when the crop allows, see decode_random_resized_crop
+    '''
+
+    def __call__(self, buf):
+        im = decode_random_resized_crop(buf, self.size, self.scale,
+                self.ratio, self.interpolation)
+        return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+
+
 class ResizeCenterCrop(object):
 
     def __init__(self, crop_size=224, short_size=256, interpolation=cv2.INTER_CUBIC):
@@ -265,12 +383,16 @@ class PCANoise(object):
         self.eig_vec = np.array(eig_vec, dtype=np.float32)
         self.eig_val = np.repeat(eig_val, 3, axis=0).astype(np.float32)
 
+    def sample_rgb(self):
+        alpha = np.random.normal(0, self.std, size=(1, 3))
+        rgb = np.sum(self.eig_vec * alpha * self.eig_val, axis=1).astype(np.float32)
+        return rgb
+
     def __call__(self, im):
         '''
         im should be CHW
         '''
-        alpha = np.random.normal(0, self.std, size=(1, 3))
-        rgb = np.sum(self.eig_vec * alpha * self.eig_val, axis=1).astype(np.float32)
+        rgb = self.sample_rgb()
         im = im + rgb.reshape(3, 1, 1)
         return im
 
@@ -417,6 +539,101 @@ class Normalize(object):
         return im
 
 
+class RandomResizedCropFlipNormalize(object):
+    '''
+        fused RandomResizedCrop, RandomHorizontalFlip, ToTensor, PCANoise and
+        Normalize. The crop is resized and flipped into buffers owned by the
+        transform, then written as normalized float32 CHW into `out` with one
+        pass per channel, pca noise is folded into the per-channel bias.
+        mid_trans (such as RandomAugment) is applied to the uint8 image
+        between flip and normalize, same position as the unfused pipeline.
+    '''
+
+    def __init__(self, size, mean, std, pca_std=None, scale=(0.08, 1.0),
+            ratio=(3. / 4., 4. / 3.), flip_p=0.5, interpolation=cv2.INTER_CUBIC,
+            mid_trans=None):
+        self.size = (size, size)
+        self.scale = scale
+        self.ratio = ratio
+        self.flip_p = flip_p
+        self.interpolation = interpolation
+        self.mid_trans = mid_trans
+        self.pca_noise = None if pca_std is None else PCANoise(pca_std)
+        # (im / 255 + rgb - mean) / std == im * mul + (rgb - mean) / std
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+        self.mul = 1. / (255. * self.std)
+        self.resize_buf = np.empty((*self.size, 3), dtype=np.uint8)
+        self.color_buf = np.empty((*self.size, 3), dtype=np.uint8)
+        self.flip_buf = np.empty((*self.size, 3), dtype=np.uint8)
+
+    def __call__(self, img, out=None):
+        '''
+            img is either decoded RGB image or encoded bytes (1-d uint8)
+        '''
+        if img.ndim == 1:
+            im = decode_random_resized_crop(img, self.size, self.scale,
+                    self.ratio, self.interpolation, dst=self.resize_buf)
+            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB, dst=self.color_buf)
+        else:
+            i, j, h, w = RandomResizedCrop.get_params(img, self.scale, self.ratio)
+            im = cv2.resize(img[i:i+h, j:j+w, :], dsize=self.size[::-1],
+                    dst=self.resize_buf, interpolation=self.interpolation)
+        if not random.random() > self.flip_p:
+            im = cv2.flip(im, 1, dst=self.flip_buf)
+        if not self.mid_trans is None: im = self.mid_trans(im)
+
+        rgb = 0. if self.pca_noise is None else self.pca_noise.sample_rgb()
+        bias = ((rgb - self.mean) / self.std).astype(np.float32)
+        if out is None:
+            out = np.empty((im.shape[2], *self.size), dtype=np.float32)
+        for c in range(im.shape[2]):
+            np.multiply(im[:, :, c], self.mul[c], out=out[c], dtype=np.float32)
+            np.add(out[c], bias[c], out=out[c])
+        return out
+
+
+class ToCHW(object):
+    '''
+        HWC uint8 ndarray to contiguous CHW uint8, used when the float
+        conversion and normalization are done on the whole batch
+    '''
+
+    def __call__(self, pic):
+        if not(_is_numpy_image(pic)):
+            raise TypeError('pic should be ndarray. Got {}'.format(type(pic)))
+        return np.ascontiguousarray(pic.transpose((2, 0, 1)))
+
+
+### batch transforms, work on NCHW tensors on any device
+class BatchToTensor(object):
+
+    def __call__(self, ims):
+        return ims.float().div_(255.)
+
+
+class BatchPCANoise(PCANoise):
+
+    def __call__(self, ims):
+        alpha = torch.randn(ims.size(0), 1, 3, device=ims.device) * self.std
+        eig_vec = torch.from_numpy(self.eig_vec).to(ims.device)
+        eig_val = torch.from_numpy(self.eig_val).to(ims.device)
+        rgb = (eig_vec[None] * alpha * eig_val[None]).sum(dim=2)
+        return ims + rgb.view(-1, 3, 1, 1)
+
+
+class BatchNormalize(object):
+
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, ims):
+        if not self.mean.device == ims.device:
+            self.mean, self.std = self.mean.to(ims.device), self.std.to(ims.device)
+        return (ims - self.mean) / self.std
+
+
 #  class ToTensor(object):
 #      """Convert a ``PIL Image`` or ``numpy.ndarray`` to tensor.
 #      Converts a PIL Image or numpy.ndarray (H x W x C) in the range
@@ -473,3 +690,56 @@ class Normalize(object):
 #      def __repr__(self):
 #          return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
 
+
+if __name__ == '__main__':
+    import time
+
+    ## fused train transform versus the separate steps
+    img = np.random.randint(0, 256, (60, 80, 3), dtype=np.uint8)
+    img = cv2.resize(img, (500, 375), interpolation=cv2.INTER_CUBIC)
+    mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    trans = Compose([
+        RandomResizedCrop(224),
+        RandomHorizontalFlip(),
+        ToTensor(),
+        PCANoise(0.1),
+        Normalize(mean, std)
+    ])
+    trans_fused = RandomResizedCropFlipNormalize(224, mean, std, pca_std=0.1)
+    out_fused = np.empty((3, 224, 224), dtype=np.float32)
+    max_diff = 0
+    for seed in range(100):
+        random.seed(seed)
+        np.random.seed(seed)
+        out = trans(img)
+        random.seed(seed)
+        np.random.seed(seed)
+        trans_fused(img, out=out_fused)
+        max_diff = max(max_diff, np.abs(out - out_fused).max())
+    print('fused transform max diff: {}'.format(max_diff))
+    assert max_diff < 1e-5
+
+    n_test = 1000
+    t1 = time.time()
+    for _ in range(n_test): trans(img)
+    t2 = time.time()
+    for _ in range(n_test): trans_fused(img, out=out_fused)
+    t3 = time.time()
+    print('separate time: {}'.format(t2 - t1))
+    print('fused time: {}'.format(t3 - t2))
+
+    ## reduced resolution decode versus full decode, on a 1200x900 jpeg
+    img = cv2.resize(img, (1200, 900), interpolation=cv2.INTER_CUBIC)
+    buf = cv2.imencode('.jpg', img)[1].ravel()
+    assert jpeg_size(buf) == (900, 1200)
+    crop = RandomResizedCrop(224)
+    crop_decode = DecodeRandomResizedCrop(224)
+    t1 = time.time()
+    for _ in range(n_test):
+        im = cv2.cvtColor(cv2.imdecode(buf, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        crop(im)
+    t2 = time.time()
+    for _ in range(n_test): crop_decode(buf)
+    t3 = time.time()
+    print('full decode time: {}'.format(t2 - t1))
+    print('reduced decode time: {}'.format(t3 - t2))